@@ -12,8 +12,104 @@ FRAMES_BUCKET = os.getenv("CLASSROOM_FRAMES_BUCKET", "classroom-frames")
 
 USE_GPU = os.getenv("USE_GPU", "true").lower() in ("1", "true", "yes")
 DET_SIZE = int(os.getenv("DETECTION_SIZE", "1024"))
+# "fixed": always DETECTION_SIZE; "adaptive": pick per frame from DETECTION_SIZES based on
+# frame size, EXPECTED_FACE_PX (0 = unknown) and an optional per-request det_size_hint;
+# "tiled": full-resolution frame split into overlapping TILE_SIZE tiles (large halls);
+# "coarse_to_fine": COARSE_DETECTION_SIZE pass, then TILE_SIZE tiles only around small faces
+DETECTION_MODE = os.getenv("DETECTION_MODE", "fixed").lower()
+DETECTION_SIZES = tuple(int(x) for x in os.getenv("DETECTION_SIZES", "320,480,640,800,1024,1280,1600").split(",") if x.strip())
+EXPECTED_FACE_PX = int(os.getenv("EXPECTED_FACE_PX", "0"))
+TILE_SIZE = int(os.getenv("TILE_SIZE", "640"))
+# overlap between neighbouring tiles; should exceed the largest back-row face
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "128"))
+COARSE_DET_SIZE = int(os.getenv("COARSE_DETECTION_SIZE", "640"))
+# coarse detections smaller than this (detector pixels) are re-detected at the
+# resolution that brings them to this size (at most native), in at most REFINE_MAX_TILES tiles
+REFINE_FACE_PX = int(os.getenv("REFINE_FACE_PX", "48"))
+REFINE_MAX_TILES = int(os.getenv("REFINE_MAX_TILES", "8"))
+# per-room seat-area ROIs registered through /rooms/{room_id}/rois; "" keeps them in memory only
+ROOM_ROIS_PATH = os.getenv("ROOM_ROIS_PATH", ".cache/room_rois.json")
+# detector input for enrollment portraits (same model, smaller input)
+ENROLL_DET_SIZE = int(os.getenv("ENROLL_DETECTION_SIZE", "640"))
 SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.40"))
-DET_CONF_THRESHOLD = float(os.getenv("DET_CONF_THRESHOLD", "0.25"))
+# SCRFD score threshold; 0.5 is insightface's own default (lower finds more
+# small/blurred faces at the cost of false positives)
+DET_CONF_THRESHOLD = float(os.getenv("DET_CONF_THRESHOLD", "0.5"))
+# detections smaller than this (shorter bbox side, original pixels) skip recognition
+MIN_FACE_SIZE = int(os.getenv("MIN_FACE_SIZE", "20"))
+MODEL_PACK = os.getenv("MODEL_PACK", "buffalo_l")
+REC_BATCH_SIZE = int(os.getenv("REC_BATCH_SIZE", "32"))
+
+# JPEGs much larger than DET_SIZE may be decoded at 1/2, 1/4 or 1/8 resolution.
+# Smallest frame face (original pixels) that must keep full recognition detail
+# (112 px) after reduction; faces are aligned from the decoded image, so the
+# default keeps every face of 112 px or more intact (i.e. frames are not reduced).
+# Raise it to trade small-face accuracy for decode speed; 0 = only the detection
+# size limits the reduction.
+DECODE_MIN_FACE_PX = int(os.getenv("DECODE_MIN_FACE_PX", "112"))
+# same for enrollment portraits, whose faces are hundreds of pixels: the default
+# allows up to a 1/4 decode (a 448 px face keeps 112 px)
+ENROLL_DECODE_MIN_FACE_PX = int(os.getenv("ENROLL_DECODE_MIN_FACE_PX", "448"))
+
+# shared keep-alive HTTP pool for storage and frame downloads
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.3"))
+
+# signed URLs for private buckets are cached until shortly before they expire
+SIGNED_URL_TTL_SECONDS = int(os.getenv("SIGNED_URL_TTL_SECONDS", "3600"))
+
+# "prefix": list only the requested <roll_id>/ folders (folder names must be lowercase roll IDs)
+# "full": walk the whole student bucket and filter (case-insensitive folder match)
+STORAGE_LISTING_MODE = os.getenv("STORAGE_LISTING_MODE", "prefix").lower()
+STORAGE_LIST_WORKERS = int(os.getenv("STORAGE_LIST_WORKERS", "8"))
+
+# enrollment pipeline: parallel downloads, parallel decode, in-order inference
+ENROLL_IO_WORKERS = int(os.getenv("ENROLL_IO_WORKERS", "8"))
+ENROLL_DECODE_WORKERS = int(os.getenv("ENROLL_DECODE_WORKERS", "2"))
+ENROLL_PIPELINE_DEPTH = int(os.getenv("ENROLL_PIPELINE_DEPTH", "16"))
+
+# worker threads for decode/detect/embed on the async endpoint
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+# threads running the frame download + detection branch of /recognize_upload
+FRAME_WORKERS = int(os.getenv("FRAME_WORKERS", "8"))
+
+# local SQLite catalogue of student bucket objects; set to "" to list storage on every build
+BUCKET_INDEX_PATH = os.getenv("BUCKET_INDEX_PATH", ".cache/bucket_index.sqlite3")
+BUCKET_INDEX_FULL_SYNC_SECONDS = float(os.getenv("BUCKET_INDEX_FULL_SYNC_SECONDS", "3600"))
+BUCKET_INDEX_REFRESH_SECONDS = float(os.getenv("BUCKET_INDEX_REFRESH_SECONDS", "60"))
+
+# on-disk cache of enrollment embeddings; set to "" to disable
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", ".cache/embeddings")
+
+# in-memory per-student gallery cache; 0 MB disables it
+GALLERY_CACHE_MAX_MB = float(os.getenv("GALLERY_CACHE_MAX_MB", "256"))
+GALLERY_CACHE_TTL_SECONDS = float(os.getenv("GALLERY_CACHE_TTL_SECONDS", "900"))
+# published (immutable, hot-swapped) galleries kept per roster; 0 disables.
+# A roster is dropped when one of its students leaves the gallery cache.
+GALLERY_SNAPSHOT_ROSTERS = int(os.getenv("GALLERY_SNAPSHOT_ROSTERS", "64"))
+
+# ONNX Runtime session options per model (detector "DET", recognizer "REC").
+# ORT_<MODEL>_<SETTING> overrides ORT_<SETTING>; thread counts of 0 keep ORT's default
+# (one thread per core per session, which oversubscribes with several workers).
+def _ort_setting(model, name, default):
+    return os.getenv(f"ORT_{model}_{name}", os.getenv(f"ORT_{name}", default))
+
+def _ort_options(model):
+    return {
+        "intra_op_threads": int(_ort_setting(model, "INTRA_OP_THREADS", "0")),
+        "inter_op_threads": int(_ort_setting(model, "INTER_OP_THREADS", "0")),
+        "execution_mode": _ort_setting(model, "EXECUTION_MODE", "sequential").lower(),        # sequential | parallel
+        "graph_optimization": _ort_setting(model, "GRAPH_OPTIMIZATION", "all").lower(),       # disable | basic | extended | all
+        "providers": [p.strip() for p in _ort_setting(model, "PROVIDERS", "").split(",") if p.strip()],  # "" = from USE_GPU
+        "cpu_mem_arena": _ort_setting(model, "CPU_MEM_ARENA", "true").lower() in ("1", "true", "yes"),
+        "mem_pattern": _ort_setting(model, "MEM_PATTERN", "true").lower() in ("1", "true", "yes"),
+        "arena_extend_strategy": _ort_setting(model, "ARENA_EXTEND_STRATEGY", ""),              # GPU: kNextPowerOfTwo | kSameAsRequested
+        "gpu_mem_limit_mb": int(_ort_setting(model, "GPU_MEM_LIMIT_MB", "0")),
+    }
+
+ORT_DET_OPTIONS = _ort_options("DET")
+ORT_REC_OPTIONS = _ort_options("REC")
 
 # sanity check
 if not SUPABASE_URL or not SUPABASE_KEY:
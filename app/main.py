@@ -1,121 +1,264 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import io
 import json
 import uvicorn
 import time
-import requests
 
 from app.config import (
-    SUPABASE_URL, SUPABASE_KEY, STUDENT_BUCKET,
-    USE_GPU, DET_SIZE, SIMILARITY_THRESHOLD, DET_CONF_THRESHOLD, SUPABASE_SERVICE_ROLE_KEY
+    SUPABASE_URL, SUPABASE_KEY, STUDENT_BUCKET, FRAMES_BUCKET,
+    USE_GPU, DET_SIZE, ENROLL_DET_SIZE, DETECTION_MODE, DETECTION_SIZES, EXPECTED_FACE_PX,
+    TILE_SIZE, TILE_OVERLAP, COARSE_DET_SIZE, REFINE_FACE_PX, REFINE_MAX_TILES,
+    ROOM_ROIS_PATH,
+    SIMILARITY_THRESHOLD, DET_CONF_THRESHOLD, SUPABASE_SERVICE_ROLE_KEY,
+    MODEL_PACK, REC_BATCH_SIZE, STORAGE_LISTING_MODE, STORAGE_LIST_WORKERS,
+    EMBEDDING_STORE_DIR, GALLERY_CACHE_MAX_MB, GALLERY_CACHE_TTL_SECONDS, GALLERY_SNAPSHOT_ROSTERS,
+    BUCKET_INDEX_PATH, BUCKET_INDEX_FULL_SYNC_SECONDS, BUCKET_INDEX_REFRESH_SECONDS,
+    HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_FACTOR, SIGNED_URL_TTL_SECONDS,
+    ENROLL_IO_WORKERS, ENROLL_DECODE_WORKERS, ENROLL_PIPELINE_DEPTH, INFERENCE_WORKERS,
+    FRAME_WORKERS, DECODE_MIN_FACE_PX, ENROLL_DECODE_MIN_FACE_PX, MIN_FACE_SIZE, ORT_DET_OPTIONS, ORT_REC_OPTIONS
 )
 
 from app.services.supabase_service import SupabaseService
+from app.utils import http_client
 from app.services.face_service import FaceService
+from app.services.embedding_store import EmbeddingStore, settings_fingerprint
+from app.services.gallery_cache import GalleryCache
+from app.services.gallery import GallerySnapshots
+from app.services.bucket_index import BucketIndex
+from app.services.room_rois import RoomROIRegistry
 
-app = FastAPI(title="Face Attendance API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # load + warm up the models in the background; /ready reports when done.
+    # A failed attempt (e.g. model download) is retried with backoff, so the
+    # instance still becomes ready once the cause goes away
+    loop = asyncio.get_running_loop()
 
-supa = SupabaseService(SUPABASE_URL, SUPABASE_KEY, service_role_key=SUPABASE_SERVICE_ROLE_KEY)
+    async def warm_up():
+        delay = 5
+        while True:
+            try:
+                await loop.run_in_executor(inference_executor, face_svc.warm_up)
+                return
+            except Exception as e:
+                print(f"[WARN] Model warm-up failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 300)
+
+    warm_up_task = asyncio.create_task(warm_up())
+    # build / refresh the storage catalogue off the request path
+    if face_svc.bucket_index is not None:
+        face_svc.bucket_index.start_full_sync(supa, STUDENT_BUCKET)
+    yield
+    warm_up_task.cancel()
+    await http_client.aclose_async_client()
+    face_svc.close()
+    inference_executor.shutdown(wait=False)
+    frame_executor.shutdown(wait=False)
+
+app = FastAPI(title="Face Attendance API", lifespan=lifespan)
+
+# every thread that can download at once (enrollment I/O pool + frame branch)
+# needs its own keep-alive connection; with pool_block=False, connections
+# beyond the pool size are opened and then discarded instead of reused
+_download_threads = ENROLL_IO_WORKERS + FRAME_WORKERS
+if HTTP_POOL_SIZE < _download_threads:
+    print(f"[WARN] HTTP_POOL_SIZE={HTTP_POOL_SIZE} is below the {_download_threads} download threads, using {_download_threads}")
+http_client.configure(pool_size=max(HTTP_POOL_SIZE, _download_threads), max_retries=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR)
+
+supa = SupabaseService(
+    SUPABASE_URL, SUPABASE_KEY,
+    service_role_key=SUPABASE_SERVICE_ROLE_KEY,
+    signed_url_ttl=SIGNED_URL_TTL_SECONDS
+)
 
 face_svc = FaceService(
     supa,
     student_bucket=STUDENT_BUCKET,
     use_gpu=USE_GPU,
     det_size=(DET_SIZE, DET_SIZE),
+    enroll_det_size=(ENROLL_DET_SIZE, ENROLL_DET_SIZE),
+    det_mode=DETECTION_MODE,
+    det_sizes=DETECTION_SIZES,
+    expected_face_px=EXPECTED_FACE_PX,
+    tile_size=TILE_SIZE,
+    tile_overlap=TILE_OVERLAP,
+    coarse_det_size=COARSE_DET_SIZE,
+    refine_face_px=REFINE_FACE_PX,
+    refine_max_tiles=REFINE_MAX_TILES,
+    roi_registry=RoomROIRegistry(ROOM_ROIS_PATH or None),
     sim_threshold=SIMILARITY_THRESHOLD,
-    det_conf_threshold=DET_CONF_THRESHOLD
+    det_conf_threshold=DET_CONF_THRESHOLD,
+    model_name=MODEL_PACK,
+    det_session_options=ORT_DET_OPTIONS,
+    rec_session_options=ORT_REC_OPTIONS,
+    rec_batch_size=REC_BATCH_SIZE,
+    listing_mode=STORAGE_LISTING_MODE,
+    list_workers=STORAGE_LIST_WORKERS,
+    enroll_io_workers=ENROLL_IO_WORKERS,
+    enroll_decode_workers=ENROLL_DECODE_WORKERS,
+    enroll_pipeline_depth=ENROLL_PIPELINE_DEPTH,
+    decode_min_face_px=DECODE_MIN_FACE_PX,
+    enroll_decode_min_face_px=ENROLL_DECODE_MIN_FACE_PX,
+    min_face_size=MIN_FACE_SIZE,
+    bucket_index=BucketIndex(
+        BUCKET_INDEX_PATH,
+        full_sync_seconds=BUCKET_INDEX_FULL_SYNC_SECONDS,
+        refresh_seconds=BUCKET_INDEX_REFRESH_SECONDS
+    ) if BUCKET_INDEX_PATH else None,
+    embedding_store=EmbeddingStore(
+        EMBEDDING_STORE_DIR, MODEL_PACK,
+        # stored embeddings / "no face" results are only valid for these enrollment settings
+        fingerprint=settings_fingerprint(
+            enroll_det_size=ENROLL_DET_SIZE,
+            det_conf_threshold=DET_CONF_THRESHOLD,
+            enroll_decode_min_face_px=ENROLL_DECODE_MIN_FACE_PX,
+        )
+    ) if EMBEDDING_STORE_DIR else None,
+    gallery_cache=GalleryCache(
+        max_bytes=int(GALLERY_CACHE_MAX_MB * 1024 * 1024),
+        ttl_seconds=GALLERY_CACHE_TTL_SECONDS
+    ) if GALLERY_CACHE_MAX_MB > 0 else None,
+    gallery_snapshots=GallerySnapshots(GALLERY_SNAPSHOT_ROSTERS) if GALLERY_SNAPSHOT_ROSTERS > 0 else None
 )
 
+# bounded pool for CPU work of the async endpoint (decode / detect / embed)
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+# frame download + detection branch of the sync endpoint, run alongside the gallery build
+frame_executor = ThreadPoolExecutor(max_workers=FRAME_WORKERS, thread_name_prefix="frame")
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
-@app.post("/recognize_upload")
-def recognize_upload(
-    session_id: str = Form(...),
-    enrolled: str = Form(...),
-    image_url: str = Form(...),
-    image_name: Optional[str] = Form(None)
-):
+@app.get("/ready")
+def ready():
+    """Readiness: 503 until the models are loaded and warmed up."""
+    if not face_svc.ready:
+        raise HTTPException(503, "Models are warming up")
+    return {"status": "ready"}
+
+@app.get("/cache_stats")
+def cache_stats():
+    return face_svc.cache_stats()
 
+@app.post("/rooms/{room_id}/rois")
+def register_room_rois(
+    room_id: str,
+    rois: str = Form(...),
+    frame_width: int = Form(...),
+    frame_height: int = Form(...)
+):
+    """
+    Register the seat areas of a fixed-camera room. `rois` is a JSON list of
+    {"rect": [x0, y0, x1, y1]} or {"polygon": [[x, y], ...]} in pixels of a
+    frame_width x frame_height frame.
+    """
     try:
-        enrolled_list = json.loads(enrolled)
-        if not isinstance(enrolled_list, list):
-            raise ValueError()
-    except Exception:
-        enrolled_list = [x.strip() for x in enrolled.split(",") if x.strip()]
+        roi_list = json.loads(rois)
+        if not isinstance(roi_list, list):
+            raise ValueError("rois must be a JSON list")
+        room = face_svc.roi_registry.register(room_id, frame_width, frame_height, roi_list)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(400, f"Invalid ROIs: {str(e)}")
+    return {"room_id": room_id, **room}
 
-    enrolled_list = [str(x).strip().lower() for x in enrolled_list]
+@app.get("/rooms/{room_id}/rois")
+def get_room_rois(room_id: str):
+    room = face_svc.roi_registry.get(room_id)
+    if room is None:
+        raise HTTPException(404, f"No ROIs registered for room {room_id}")
+    return {"room_id": room_id, **room}
 
+@app.delete("/rooms/{room_id}/rois")
+def delete_room_rois(room_id: str):
+    if not face_svc.roi_registry.remove(room_id):
+        raise HTTPException(404, f"No ROIs registered for room {room_id}")
+    return {"room_id": room_id, "deleted": True}
+
+class FrameFetchError(Exception):
+    pass
+
+def check_room(room_id: Optional[str]):
+    if room_id is not None and room_id not in face_svc.roi_registry:
+        raise HTTPException(404, f"No ROIs registered for room {room_id}")
+
+def check_frame_source(image: Optional[UploadFile], frame_path: Optional[str], image_url: Optional[str]):
+    given = [x for x in (image, frame_path, image_url) if x]
+    if len(given) != 1:
+        raise HTTPException(400, "Provide exactly one of: image (file upload), frame_path, image_url")
+
+def upload_buffer(image: UploadFile):
+    """
+    Bytes of an uploaded frame. While the spooled upload is still in memory
+    BytesIO.getvalue() hands back its own buffer (CPython shares it instead of
+    copying); once spooled to disk it is read in one go.
+    """
+    f = image.file
+    inner = getattr(f, "_file", f)
+    if isinstance(inner, io.BytesIO):
+        return inner.getvalue()
+    f.seek(0)
+    return f.read()
+
+def fetch_frame_bytes(frame_path: Optional[str], image_url: Optional[str]) -> bytes:
+    if frame_path:
+        frame_bytes = supa.download_bytes(FRAMES_BUCKET, frame_path)
+        if not frame_bytes:
+            raise FrameFetchError(f"{frame_path} not found in {FRAMES_BUCKET}")
+        return frame_bytes
     try:
-        response = requests.get(image_url, timeout=10)
+        response = http_client.get_session().get(image_url, timeout=10)
         response.raise_for_status()
-        frame_bytes = response.content
+        return response.content
     except Exception as e:
-        raise HTTPException(400, f"Cannot fetch image: {str(e)}")
+        raise FrameFetchError(str(e))
 
-    # Build embeddings (be defensive about return shape)
+async def fetch_frame_bytes_async(frame_path: Optional[str], image_url: Optional[str]) -> bytes:
+    if frame_path:
+        frame_bytes = await supa.download_bytes_async(FRAMES_BUCKET, frame_path)
+        if not frame_bytes:
+            raise FrameFetchError(f"{frame_path} not found in {FRAMES_BUCKET}")
+        return frame_bytes
     try:
-        embeds_result = face_svc.build_embeddings_for_students(enrolled_list)
-        # Normalize build_embeddings_for_students return
-        if isinstance(embeds_result, (tuple, list)) and len(embeds_result) == 2:
-            names_arr, embs_arr = embeds_result
-        elif isinstance(embeds_result, dict):
-            # dict of name -> embedding
-            names_arr = list(embeds_result.keys())
-            embs_arr = [embeds_result[n] for n in names_arr]
-        elif isinstance(embeds_result, list):
-            # perhaps it's a list of embeddings aligned with enrolled_list
-            names_arr = enrolled_list
-            embs_arr = embeds_result
-        else:
-            raise ValueError(f"Unexpected return from build_embeddings_for_students: {type(embeds_result)}")
+        response = await http_client.get_async_client().get(image_url, timeout=10)
+        response.raise_for_status()
+        return response.content
     except Exception as e:
-        # give a clear message and log for debugging
-        raise HTTPException(500, f"Error building embeddings: {str(e)}")
+        raise FrameFetchError(str(e))
 
-    # NOW RETURNS similarity scores (defensive handling for multiple possible return types)
+def fetch_and_detect_frame(image: Optional[UploadFile], frame_path: Optional[str], image_url: Optional[str],
+                           det_size_hint: Optional[int] = None, room_id: Optional[str] = None):
+    if image is not None:
+        frame_bytes = upload_buffer(image)
+    else:
+        frame_bytes = fetch_frame_bytes(frame_path, image_url)
+    return face_svc.detect_frame(frame_bytes, det_size_hint=det_size_hint, room_id=room_id)
+
+def parse_enrolled(enrolled: str):
     try:
-        recog_result = face_svc.recognize_frame(frame_bytes, names_arr, embs_arr)
-
-        total_present = 0  # default in case something unexpected happens later
-
-        # Case A: tuple/list
-        if isinstance(recog_result, (tuple, list)):
-            if len(recog_result) == 3:
-                # recognized, similarity_map, total_present
-                recognized, similarity_map, total_present = recog_result
-            elif len(recog_result) == 2:
-                # recognized, similarity_map
-                recognized, similarity_map = recog_result
-                total_present = len(recognized)
-            else:
-                raise ValueError(f"Unexpected tuple/list length from recognize_frame: {len(recog_result)}")
-
-        # Case B: returned only a dict -> treat it as similarity_map
-        elif isinstance(recog_result, dict):
-            similarity_map = recog_result
-            sim_threshold = getattr(face_svc, "sim_threshold", SIMILARITY_THRESHOLD)
-            recognized = [name for name, sim in similarity_map.items() if (sim or 0.0) >= sim_threshold]
-            total_present = len(recognized)
-
-        # Case C: returned only a list -> treat as recognized names
-        elif isinstance(recog_result, list):
-            recognized = recog_result
-            similarity_map = {name: (1.0 if name in recognized else 0.0) for name in enrolled_list}
-            total_present = len(recognized)
+        enrolled_list = json.loads(enrolled)
+        if not isinstance(enrolled_list, list):
+            raise ValueError()
+    except Exception:
+        enrolled_list = [x.strip() for x in enrolled.split(",") if x.strip()]
 
-        else:
-            raise ValueError(f"Unexpected return from recognize_frame: {type(recog_result)}")
-    except Exception as e:
-        raise HTTPException(500, f"{str(e)}")
+    return [str(x).strip().lower() for x in enrolled_list]
 
-    # Build attendance with similarity %
+def build_response(session_id, image_name, enrolled_list, gallery, recognized_ids, scores, total_present,
+                   frame_stats=None):
+    # Build attendance with similarity % (scores are indexed by gallery student id)
+    present = set(int(i) for i in recognized_ids)
     attendance = {}
     for r in enrolled_list:
-        status = "present" if r in recognized else "absent"
-        # current similarity_map values are cosine scores like 0.8; keep same behavior as before
-        similarity = round(float(similarity_map.get(r, 0.0)), 2)
+        sid = gallery.ids.get(r)
+        status = "present" if sid in present else "absent"
+        # scores are cosine similarities like 0.8; keep same behavior as before
+        similarity = round(float(scores[sid]), 2) if sid is not None else 0.0
         attendance[r] = {
             "status": status,
             "similarity_percent": similarity
@@ -133,9 +276,114 @@ def recognize_upload(
         "session_id": session_id,
         "image_name": image_name,
         "attendance": attendance,
-        "recognized_summary": recognized,
-        "total_present": total_present
+        "recognized_summary": [gallery.names[i] for i in recognized_ids],
+        "total_present": total_present,
+        **(frame_stats or {})
     }
 
+@app.post("/recognize_upload")
+def recognize_upload(
+    session_id: str = Form(...),
+    enrolled: str = Form(...),
+    image_url: Optional[str] = Form(None),
+    image_name: Optional[str] = Form(None),
+    image: Optional[UploadFile] = File(None),
+    frame_path: Optional[str] = Form(None),
+    det_size_hint: Optional[int] = Form(None),
+    room_id: Optional[str] = Form(None)
+):
+    """
+    The frame comes from exactly one of: a multipart `image` upload, a
+    `frame_path` in the frames bucket, or an `image_url`.
+    `det_size_hint` suggests a detector input size (DETECTION_MODE=adaptive).
+    `room_id` restricts detection to the room's registered ROIs.
+    """
+    check_frame_source(image, frame_path, image_url)
+    check_room(room_id)
+    enrolled_list = parse_enrolled(enrolled)
+
+    # Frame branch (download + detect + embed) runs while this thread builds the gallery
+    frame_future = frame_executor.submit(fetch_and_detect_frame, image, frame_path, image_url, det_size_hint, room_id)
+
+    gallery_error = None
+    try:
+        gallery = face_svc.build_embeddings_for_students(enrolled_list)
+    except Exception as e:
+        gallery_error = e
+
+    try:
+        faces, frame_stats = frame_future.result()
+    except FrameFetchError as e:
+        raise HTTPException(400, f"Cannot fetch image: {str(e)}")
+    except Exception as e:
+        raise HTTPException(500, f"{str(e)}")
+
+    if gallery_error is not None:
+        # give a clear message and log for debugging
+        raise HTTPException(500, f"Error building embeddings: {str(gallery_error)}")
+
+    try:
+        recognized_ids, scores, total_present = face_svc.match_faces(faces, gallery)
+    except Exception as e:
+        raise HTTPException(500, f"{str(e)}")
+
+    return build_response(session_id, image_name, enrolled_list, gallery, recognized_ids, scores, total_present,
+                          frame_stats)
+
+@app.post("/recognize_upload_async")
+async def recognize_upload_async(
+    session_id: str = Form(...),
+    enrolled: str = Form(...),
+    image_url: Optional[str] = Form(None),
+    image_name: Optional[str] = Form(None),
+    image: Optional[UploadFile] = File(None),
+    frame_path: Optional[str] = Form(None),
+    det_size_hint: Optional[int] = Form(None),
+    room_id: Optional[str] = Form(None)
+):
+    """
+    Same contract as /recognize_upload, but waiting on the network doesn't
+    hold a thread: the frame and storage objects are fetched with the async
+    HTTP client and only decode/detect/embed runs on the inference pool.
+    """
+    check_frame_source(image, frame_path, image_url)
+    check_room(room_id)
+    enrolled_list = parse_enrolled(enrolled)
+    loop = asyncio.get_running_loop()
+
+    async def frame_branch():
+        if image is not None:
+            # UploadFile.read() runs the file I/O in a thread when the upload spooled to disk
+            frame_bytes = await image.read()
+        else:
+            frame_bytes = await fetch_frame_bytes_async(frame_path, image_url)
+        return await loop.run_in_executor(
+            inference_executor, face_svc.detect_frame, frame_bytes, det_size_hint, room_id
+        )
+
+    # frame and gallery branches run concurrently and join at matching
+    frame_result, gallery = await asyncio.gather(
+        frame_branch(),
+        face_svc.build_embeddings_for_students_async(enrolled_list, inference_executor),
+        return_exceptions=True
+    )
+
+    if isinstance(frame_result, FrameFetchError):
+        raise HTTPException(400, f"Cannot fetch image: {str(frame_result)}")
+    if isinstance(frame_result, Exception):
+        raise HTTPException(500, f"{str(frame_result)}")
+    faces, frame_stats = frame_result
+
+    if isinstance(gallery, Exception):
+        raise HTTPException(500, f"Error building embeddings: {str(gallery)}")
+
+    try:
+        recognized_ids, scores, total_present = face_svc.match_faces(faces, gallery)
+    except Exception as e:
+        raise HTTPException(500, f"{str(e)}")
+
+    return build_response(session_id, image_name, enrolled_list, gallery, recognized_ids, scores, total_present,
+                          frame_stats)
+
 if __name__ == "__main__":
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
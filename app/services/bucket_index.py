@@ -0,0 +1,305 @@
+# app/services/bucket_index.py
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from app.services.supabase_service import SupabaseService
+
+# roll_id used in sync_state for the bucket-wide (full) sync row
+_BUCKET_ROW = ""
+
+
+def roll_id_for_path(path: str) -> str:
+    return path.split("/")[0].lower().strip() if "/" in path else ""
+
+
+class BucketIndex:
+    """
+    Local SQLite catalogue of storage objects: path, roll ID, size, updated_at, ETag.
+
+    - built with a full walk of the bucket in a background thread whenever the
+      last one (by any process sharing the database) is older than
+      full_sync_seconds; picks up deletions and new roll folders. Only one
+      process walks at a time (flock on <db_path>.full_sync.lock), and
+      requests never wait for it
+    - requested roll folders are refreshed incrementally from a per-roll
+      updated_at watermark, at most every refresh_seconds; roll IDs are
+      lowercase, so folders are listed under every case the index has seen,
+      and a roll with nothing listed is looked up case-insensitively
+    - roll → images is an indexed query instead of a bucket listing
+
+    Listing happens without holding the lock; only SQLite access is serialized.
+
+    Every change to a roll's objects bumps its generation in sync_state, in
+    whichever process found it. Anything derived from a roll's photos (e.g. a
+    cached gallery block) records the generation it was built from and is
+    out of date once generations() reports a different one.
+    """
+
+    def __init__(self, db_path: str, full_sync_seconds: float = 3600, refresh_seconds: float = 60):
+        self.db_path = db_path
+        self.full_sync_seconds = full_sync_seconds
+        self.refresh_seconds = refresh_seconds
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._full_sync_thread: Optional[threading.Thread] = None
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket     TEXT NOT NULL,
+                path       TEXT NOT NULL,
+                roll_id    TEXT NOT NULL,
+                size       INTEGER,
+                updated_at TEXT,
+                etag       TEXT,
+                PRIMARY KEY (bucket, path)
+            );
+            CREATE INDEX IF NOT EXISTS idx_objects_roll ON objects (bucket, roll_id);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                bucket     TEXT NOT NULL,
+                roll_id    TEXT NOT NULL,
+                watermark  TEXT,
+                synced_at  REAL,
+                generation INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, roll_id)
+            );
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sync_state)")}
+        if "generation" not in columns:
+            self._conn.execute("ALTER TABLE sync_state ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    # ---- queries ----
+
+    def objects_for_rolls(self, bucket: str, roll_ids: List[str]) -> Dict[str, List[Dict]]:
+        roll_to_images = defaultdict(list)
+        if not roll_ids:
+            return roll_to_images
+        marks = ",".join("?" * len(roll_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT roll_id, path, etag, updated_at, size FROM objects "
+                f"WHERE bucket = ? AND roll_id IN ({marks}) ORDER BY roll_id, path",
+                [bucket, *roll_ids],
+            ).fetchall()
+        for rid, path, etag, updated_at, size in rows:
+            roll_to_images[rid].append({"path": path, "etag": etag, "updated_at": updated_at, "size": size})
+        return roll_to_images
+
+    def generations(self, bucket: str, roll_ids: List[str]) -> Dict[str, int]:
+        """Current generation of each roll (0 if never synced)."""
+        if not roll_ids:
+            return {}
+        marks = ",".join("?" * len(roll_ids))
+        with self._lock:
+            rows = dict(self._conn.execute(
+                f"SELECT roll_id, generation FROM sync_state WHERE bucket = ? AND roll_id IN ({marks})",
+                [bucket, *roll_ids],
+            ).fetchall())
+        return {rid: rows.get(rid, 0) for rid in roll_ids}
+
+    def _synced_at(self, bucket: str, roll_id: str) -> float:
+        row = self._conn.execute(
+            "SELECT synced_at FROM sync_state WHERE bucket = ? AND roll_id = ?", (bucket, roll_id)
+        ).fetchone()
+        return row[0] if row and row[0] is not None else 0.0
+
+    def _watermark(self, bucket: str, roll_id: str) -> str:
+        row = self._conn.execute(
+            "SELECT watermark FROM sync_state WHERE bucket = ? AND roll_id = ?", (bucket, roll_id)
+        ).fetchone()
+        return row[0] if row and row[0] else ""
+
+    def _folders(self, bucket: str, roll_id: str) -> Set[str]:
+        """Actual folder names (any case) the index holds objects under for this roll."""
+        rows = self._conn.execute(
+            "SELECT DISTINCT substr(path, 1, instr(path, '/') - 1) FROM objects WHERE bucket = ? AND roll_id = ?",
+            (bucket, roll_id),
+        ).fetchall()
+        return {r[0] for r in rows if r[0]}
+
+    # ---- sync ----
+
+    def _full_sync_due(self, bucket: str) -> bool:
+        return time.time() - self._synced_at(bucket, _BUCKET_ROW) > self.full_sync_seconds
+
+    def sync(self, supa: SupabaseService, bucket: str, roll_ids: List[str], max_workers: int = 8,
+             executor: Optional[ThreadPoolExecutor] = None) -> Set[str]:
+        """
+        Bring the catalogue up to date for these rolls; returns the roll IDs
+        this call found changed (changes found elsewhere show in generations()).
+        """
+        with self._lock:
+            now = time.time()
+            full_sync_due = self._full_sync_due(bucket)
+            due = [r for r in roll_ids if now - self._synced_at(bucket, r) > self.refresh_seconds]
+        if full_sync_due:
+            self.start_full_sync(supa, bucket)
+
+        if due:
+            return self.refresh_rolls(supa, bucket, due, max_workers=max_workers, executor=executor)
+        return set()
+
+    def start_full_sync(self, supa: SupabaseService, bucket: str) -> bool:
+        """
+        Run full_sync in a background thread unless one is already running in
+        this process; True if started. The thread skips the walk if another
+        process is walking, or has walked within full_sync_seconds.
+        """
+        with self._lock:
+            if self._full_sync_thread is not None and self._full_sync_thread.is_alive():
+                return False
+
+            def run():
+                with open(self.db_path + ".full_sync.lock", "a+") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return
+                    try:
+                        with self._lock:
+                            if not self._full_sync_due(bucket):
+                                return
+                        self.full_sync(supa, bucket)
+                    except Exception as e:
+                        print(f"[WARN] Full sync of {bucket} failed: {e}")
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            self._full_sync_thread = threading.Thread(target=run, name="index-full-sync", daemon=True)
+            self._full_sync_thread.start()
+            return True
+
+    def full_sync(self, supa: SupabaseService, bucket: str) -> Set[str]:
+        started = time.time()
+        objects = supa.list_all_objects_recursive(bucket)
+        now = time.time()
+        seen = {o["path"]: o for o in objects if roll_id_for_path(o["path"])}
+
+        with self._lock, self._conn:
+            # write lock before reading, so the comparison and the generation
+            # bumps are atomic with respect to other processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            # rolls refreshed while we were listing are newer than our snapshot: leave them alone
+            fresh = {
+                rid for rid, synced_at in self._conn.execute(
+                    "SELECT roll_id, synced_at FROM sync_state WHERE bucket = ? AND roll_id != ?", (bucket, _BUCKET_ROW)
+                ) if synced_at is not None and synced_at >= started
+            }
+            seen = {p: o for p, o in seen.items() if roll_id_for_path(p) not in fresh}
+            existing = {
+                path: (rid, etag, updated_at)
+                for path, rid, etag, updated_at in self._conn.execute(
+                    "SELECT path, roll_id, etag, updated_at FROM objects WHERE bucket = ?", (bucket,)
+                ) if rid not in fresh
+            }
+            changed = {rid for path, (rid, _, _) in existing.items() if path not in seen}
+            for path, o in seen.items():
+                old = existing.get(path)
+                if old is None or old[1] != o["etag"] or old[2] != o["updated_at"]:
+                    changed.add(roll_id_for_path(path))
+
+            # every roll with a sync_state row or objects; rows are kept (not
+            # deleted) for emptied rolls so their generation keeps counting up
+            watermarks = {
+                rid: "" for (rid,) in self._conn.execute(
+                    "SELECT roll_id FROM sync_state WHERE bucket = ? AND roll_id != ?", (bucket, _BUCKET_ROW)
+                ) if rid not in fresh
+            }
+            for path, o in seen.items():
+                rid = roll_id_for_path(path)
+                watermarks[rid] = max(watermarks.get(rid, ""), o["updated_at"] or "")
+
+            self._conn.executemany(
+                "DELETE FROM objects WHERE bucket = ? AND path = ?",
+                [(bucket, p) for p in existing if p not in seen],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO objects (bucket, path, roll_id, size, updated_at, etag) VALUES (?, ?, ?, ?, ?, ?)",
+                [(bucket, p, roll_id_for_path(p), o["size"], o["updated_at"], o["etag"]) for p, o in seen.items()],
+            )
+            self._set_sync_state(bucket, [(rid, wm, rid in changed) for rid, wm in watermarks.items()]
+                                 + [(_BUCKET_ROW, "", False)], now)
+
+        print(f"[BucketIndex] Full sync of {bucket}: {len(seen)} objects, {len(changed)} rolls changed")
+        return changed
+
+    def refresh_rolls(self, supa: SupabaseService, bucket: str, roll_ids: List[str], max_workers: int = 8,
+                      executor: Optional[ThreadPoolExecutor] = None) -> Set[str]:
+        """
+        Incremental refresh of roll folders: only objects newer than each roll's
+        watermark are fetched. Lists on `executor` if given (shared pool), else
+        on a pool created for this call.
+        """
+        with self._lock:
+            watermarks = {rid: self._watermark(bucket, rid) for rid in roll_ids}
+            # prefix listings are case-sensitive: also list the folders the index
+            # already knows under another case (e.g. "ABC123/" for "abc123")
+            folders = {rid: self._folders(bucket, rid) | {rid} for rid in roll_ids}
+
+        def list_folders(pairs):
+            """[(roll_id, folder)] -> listings, newer than the roll's watermark."""
+            def list_one(pair):
+                rid, folder = pair
+                return supa.list_objects_updated_since(bucket, folder, since=watermarks[rid])
+
+            if executor is not None:
+                return list(executor.map(list_one, pairs))
+            workers = max(1, min(max_workers, len(pairs)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="index-refresh") as pool:
+                return list(pool.map(list_one, pairs))
+
+        results = defaultdict(list)
+        pairs = [(rid, f) for rid in roll_ids for f in sorted(folders[rid])]
+        for (rid, _), objects in zip(pairs, list_folders(pairs)):
+            results[rid].extend(objects)
+
+        # rolls the index has never seen and whose lowercase folder is empty:
+        # look their folder up case-insensitively
+        unknown = [rid for rid in roll_ids if not results[rid] and folders[rid] == {rid}]
+        if unknown:
+            pairs = [(rid, f) for rid, names in supa.find_folders(bucket, unknown).items() for f in names if f != rid]
+            if pairs:
+                for (rid, _), objects in zip(pairs, list_folders(pairs)):
+                    results[rid].extend(objects)
+
+        now = time.time()
+        changed = set()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            state = []
+            for rid in roll_ids:
+                objects = results[rid]
+                wm = watermarks[rid]
+                for o in objects:
+                    old = self._conn.execute(
+                        "SELECT etag, updated_at FROM objects WHERE bucket = ? AND path = ?", (bucket, o["path"])
+                    ).fetchone()
+                    if old is None or old[0] != o["etag"] or old[1] != o["updated_at"]:
+                        changed.add(rid)
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO objects (bucket, path, roll_id, size, updated_at, etag) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (bucket, o["path"], rid, o["size"], o["updated_at"], o["etag"]),
+                    )
+                    wm = max(wm, o["updated_at"] or "")
+                state.append((rid, wm, rid in changed))
+            self._set_sync_state(bucket, state, now)
+        return changed
+
+    def _set_sync_state(self, bucket: str, rows, synced_at: float):
+        """Upsert (roll_id, watermark, changed) rows, bumping the generation of changed rolls."""
+        self._conn.executemany(
+            "INSERT INTO sync_state (bucket, roll_id, watermark, synced_at, generation) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (bucket, roll_id) DO UPDATE SET watermark = excluded.watermark, "
+            "synced_at = excluded.synced_at, generation = generation + excluded.generation",
+            [(bucket, rid, wm, synced_at, int(changed)) for rid, wm, changed in rows],
+        )
@@ -0,0 +1,224 @@
+# app/services/embedding_store.py
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+def settings_fingerprint(**settings) -> str:
+    """Short stable hash of the settings an embedding (or a "no face" result) depends on."""
+    blob = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:12]
+
+
+class EmbeddingStore:
+    """
+    Persistent on-disk cache of reference-photo embeddings.
+
+    One directory per model pack (embeddings from different models are not
+    comparable) and enrollment settings fingerprint (detector size, threshold
+    and decode settings decide which face is found, or whether one is found at
+    all), laid out as:
+        <root>/<model_name>/<fingerprint>/embeddings.npy   float32 (capacity, dim), memory-mapped
+        <root>/<model_name>/<fingerprint>/index.json       {path: {"roll_id", "version", "row"}}
+        <root>/<model_name>/<fingerprint>/.lock            cross-process lock
+    Changing those settings therefore starts a fresh store, and photos that
+    had no usable face are retried.
+
+    An entry is only a hit when roll_id, path and version (ETag / updated_at)
+    all match, so a re-uploaded photo is recomputed automatically.
+    row == -1 records "no usable face" so such photos are not re-processed.
+
+    Safe to share between worker processes: put() only buffers, and flush()
+    allocates rows under an exclusive flock against the index as it is on
+    disk, writes the rows, then replaces the index. Readers take a shared
+    flock and re-read the index / re-map the matrix whenever another process
+    replaced them, so a row is never read through a stale index.
+    """
+
+    MATRIX_FILE = "embeddings.npy"
+    INDEX_FILE = "index.json"
+    LOCK_FILE = ".lock"
+
+    def __init__(self, root_dir: str, model_name: str, fingerprint: str = "", initial_capacity: int = 1024):
+        self.dir = os.path.join(root_dir, model_name, fingerprint) if fingerprint else os.path.join(root_dir, model_name)
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+        self.initial_capacity = initial_capacity
+        os.makedirs(self.dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._lock_file = open(os.path.join(self.dir, self.LOCK_FILE), "a+")
+        self._matrix: Optional[np.memmap] = None
+        self._matrix_id = None   # (st_dev, st_ino) of the mapped matrix file
+        self._index: Dict[str, Dict] = {}
+        self._index_stat = None  # (st_ino, st_mtime_ns, st_size) of the loaded index
+        # put() since the last flush: path -> (roll_id, version, embedding or None)
+        self._pending: Dict[str, Tuple[str, str, Optional[np.ndarray]]] = {}
+
+        with self._locked(exclusive=False):
+            if self._index:
+                used = sum(1 for e in self._index.values() if e.get("row", -1) >= 0)
+                print(f"[EmbeddingStore] Loaded {used} embeddings from {self.dir}")
+
+    @property
+    def matrix_path(self) -> str:
+        return os.path.join(self.dir, self.MATRIX_FILE)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.dir, self.INDEX_FILE)
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        """Thread lock + flock (flock alone doesn't exclude threads sharing the fd), then sync with disk."""
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self):
+        """Re-read the index / re-map the matrix if another process replaced them."""
+        st = self._stat(self.index_path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size) if st else None
+        if key != self._index_stat:
+            index = {}
+            if st is not None:
+                try:
+                    with open(self.index_path, "r") as f:
+                        index = json.load(f)
+                except Exception as e:
+                    print(f"[EmbeddingStore] Ignoring unreadable index in {self.dir}: {e}")
+            self._index = index
+            self._index_stat = key
+            changed = True
+        else:
+            changed = False
+
+        mst = self._stat(self.matrix_path)
+        matrix_id = (mst.st_dev, mst.st_ino) if mst else None
+        if matrix_id != self._matrix_id:
+            self._matrix = np.load(self.matrix_path, mmap_mode="r+") if mst else None
+            self._matrix_id = matrix_id
+            changed = True
+
+        # only after a reload: the loaded index / mapped matrix are otherwise unchanged
+        if changed:
+            rows = [e["row"] for e in self._index.values() if e.get("row", -1) >= 0]
+            if rows and (self._matrix is None or max(rows) >= self._matrix.shape[0]):
+                print(f"[EmbeddingStore] Index/matrix mismatch in {self.dir}, ignoring index")
+                self._index = {}
+
+    def _grow(self, rows: int, dim: int):
+        """Grow (or create) the memmap to at least `rows` rows. Exclusive lock held."""
+        old = self._matrix
+        if old is not None and old.shape[1] != dim:
+            raise ValueError(f"Embedding dim {dim} does not match store dim {old.shape[1]}")
+        if old is not None and rows <= old.shape[0]:
+            return
+
+        capacity = max(self.initial_capacity, rows, 2 * old.shape[0] if old is not None else 0)
+        tmp_path = self.matrix_path + ".tmp"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, dim))
+        if old is not None:
+            grown[:old.shape[0]] = old
+        grown.flush()
+        del grown
+        self._matrix = None
+        del old
+        # other processes keep their (still valid) old mapping until their next _refresh
+        os.replace(tmp_path, self.matrix_path)
+        self._matrix = np.load(self.matrix_path, mmap_mode="r+")
+        st = os.stat(self.matrix_path)
+        self._matrix_id = (st.st_dev, st.st_ino)
+
+    def lookup(self, roll_id: str, path: str, version: str) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        Returns (hit, embedding). On a hit the embedding may be None, meaning
+        the photo was processed before and yielded no usable face.
+        """
+        if not version:
+            return False, None
+        with self._lock:
+            pending = self._pending.get(path)
+            if pending is not None and pending[0] == roll_id and pending[1] == version:
+                return True, (None if pending[2] is None else pending[2].copy())
+        with self._locked(exclusive=False):
+            entry = self._index.get(path)
+            if entry is None or entry.get("roll_id") != roll_id or entry.get("version") != version:
+                return False, None
+            row = entry.get("row", -1)
+            if row < 0:
+                return True, None
+            return True, np.array(self._matrix[row], dtype=np.float32)
+
+    def put(self, roll_id: str, path: str, version: str, emb: Optional[np.ndarray]):
+        """Record the embedding (or None for "no face") for this photo version; persisted by flush()."""
+        if not version:
+            return
+        if emb is not None:
+            emb = np.asarray(emb, dtype=np.float32).ravel().copy()
+        with self._lock:
+            self._pending[path] = (roll_id, version, emb)
+
+    def flush(self):
+        """
+        Persist pending puts. Under the exclusive lock, rows are allocated
+        from the rows the on-disk index doesn't reference (so a crash never
+        leaves the index pointing at overwritten data), written and flushed,
+        then the index is replaced atomically (index last).
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            with self._locked(exclusive=True):
+                pending, self._pending = self._pending, {}
+                index = dict(self._index)
+                used = {e["row"] for e in index.values() if e.get("row", -1) >= 0}
+                size = self._matrix.shape[0] if self._matrix is not None else 0
+                free = (r for r in range(size) if r not in used)
+
+                writes = []
+                next_row = size
+                for path, (roll_id, version, emb) in pending.items():
+                    row = -1
+                    if emb is not None:
+                        row = next(free, None)
+                        if row is None:
+                            row = next_row
+                            next_row += 1
+                        writes.append((row, emb))
+                    index[path] = {"roll_id": roll_id, "version": version, "row": row}
+
+                if writes:
+                    self._grow(next_row, writes[0][1].shape[0])
+                    for row, emb in writes:
+                        self._matrix[row] = emb
+                    self._matrix.flush()
+
+                tmp_path = self.index_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, self.index_path)
+                self._index = index
+                st = os.stat(self.index_path)
+                self._index_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def __len__(self):
+        with self._locked(exclusive=False):
+            return sum(1 for e in self._index.values() if e.get("row", -1) >= 0)
@@ -1,13 +1,37 @@
 # app/services/face_service.py
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.utils import face_align
 import numpy as np
 from typing import Tuple, Dict, List, Optional
-from app.utils.image_utils import bytes_to_bgr_image
+from app.utils.image_utils import (
+    REC_FACE_PX, bytes_to_bgr_image, decode_image_for_detection, read_image_size,
+)
+from app.utils.detection_utils import tile_grid, merge_detections
+from app.utils.single_flight import SingleFlight
+from app.utils.ort_options import make_session_options, resolve_providers, describe_session
 from app.services.supabase_service import SupabaseService
+from app.services.embedding_store import EmbeddingStore
+from app.services.gallery_cache import GalleryCache
+from app.services.bucket_index import BucketIndex
+from app.services.room_rois import RoomROIRegistry, RoomGeometry
+from app.services.gallery import Gallery, GallerySnapshots
 import cv2
+import glob
+import onnx
+import onnxruntime
+import os
+import asyncio
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import re
+import threading
+
+# SCRFD finds faces reliably down to roughly this size in detector pixels
+MIN_DET_FACE_PX = 16
 
 class FaceService:
     def __init__(
@@ -17,7 +41,33 @@ class FaceService:
         use_gpu: bool = False,
         det_size: Tuple[int,int] = (1024,1024),
         sim_threshold: float = 0.55,
-        det_conf_threshold: float = 0.25,
+        det_conf_threshold: float = 0.5,
+        model_name: str = "buffalo_l",
+        embedding_store: Optional[EmbeddingStore] = None,
+        gallery_cache: Optional[GalleryCache] = None,
+        rec_batch_size: int = 32,
+        listing_mode: str = "prefix",
+        list_workers: int = 8,
+        bucket_index: Optional[BucketIndex] = None,
+        enroll_io_workers: int = 8,
+        enroll_decode_workers: int = 2,
+        enroll_pipeline_depth: int = 16,
+        decode_min_face_px: int = REC_FACE_PX,
+        enroll_decode_min_face_px: int = 4 * REC_FACE_PX,
+        min_face_size: int = 0,
+        enroll_det_size: Optional[Tuple[int, int]] = (640, 640),
+        det_mode: str = "fixed",
+        det_sizes: Tuple[int, ...] = (320, 480, 640, 800, 1024, 1280, 1600),
+        expected_face_px: int = 0,
+        tile_size: int = 640,
+        tile_overlap: int = 128,
+        coarse_det_size: int = 640,
+        refine_face_px: int = 48,
+        refine_max_tiles: int = 8,
+        roi_registry: Optional[RoomROIRegistry] = None,
+        gallery_snapshots: Optional[GallerySnapshots] = None,
+        det_session_options: Optional[Dict] = None,
+        rec_session_options: Optional[Dict] = None,
     ):
         self.supa = supa
         self.student_bucket = student_bucket
@@ -25,37 +75,328 @@ class FaceService:
         self.det_size = det_size
         self.sim_threshold = sim_threshold
         self.det_conf_threshold = det_conf_threshold
+        self.model_name = model_name
+        self.embedding_store = embedding_store
+        self.gallery_cache = gallery_cache
+        self.rec_batch_size = rec_batch_size
+        self.listing_mode = listing_mode
+        self.list_workers = list_workers
+        self.bucket_index = bucket_index
+        self.enroll_io_workers = enroll_io_workers
+        self.enroll_decode_workers = enroll_decode_workers
+        self.enroll_pipeline_depth = enroll_pipeline_depth
+        self.decode_min_face_px = decode_min_face_px
+        self.enroll_decode_min_face_px = enroll_decode_min_face_px
+        self.min_face_size = min_face_size
+        # enrollment photos are single-person portraits: detect them at a small input size
+        self.enroll_det_size = enroll_det_size
+        # "fixed": always det_size; "adaptive": pick from det_sizes per frame;
+        # "tiled": full-resolution frame in overlapping tile_size tiles;
+        # "coarse_to_fine": coarse_det_size pass, then tiles only around small faces,
+        # at the resolution that brings them to refine_face_px
+        self.det_mode = det_mode
+        self.det_sizes = tuple(sorted(det_sizes))
+        self.expected_face_px = expected_face_px
+        self.tile_size = tile_size
+        self.tile_overlap = min(tile_overlap, tile_size // 2)
+        self.coarse_det_size = coarse_det_size
+        self.refine_face_px = refine_face_px
+        self.refine_max_tiles = refine_max_tiles
+        # per-room seat areas; a request with a room_id detects only inside them
+        self.roi_registry = roi_registry
+        # published per-roster galleries; only usable on top of the gallery cache,
+        # whose read-only blocks identify a snapshot's contents
+        self.gallery_snapshots = gallery_snapshots if gallery_cache is not None else None
+        if self.gallery_snapshots is not None:
+            # a snapshot must not outlive the cached blocks it was built from
+            gallery_cache.on_evict = self.gallery_snapshots.drop_students
+        # concurrent requests for the same roster share one build per (bucket, roll ID)
+        self.single_flight = SingleFlight()
+        # ONNX Runtime settings per model (see ORT_*_OPTIONS in app/config.py)
+        self.det_session_options = det_session_options or {}
+        self.rec_session_options = rec_session_options or {}
+        # shared by every build (sync, background refresh, index refresh) and
+        # created once, so their threads and HTTP connections are reused;
+        # main.py sizes the HTTP pool to cover them
+        self._io_pool = ThreadPoolExecutor(max_workers=max(1, enroll_io_workers), thread_name_prefix="enroll-io")
+        self._decode_pool = ThreadPoolExecutor(max_workers=max(1, enroll_decode_workers), thread_name_prefix="enroll-decode")
+        self._list_pool = ThreadPoolExecutor(max_workers=max(1, list_workers), thread_name_prefix="storage-list")
         self.fa = None
+        self._init_lock = threading.Lock()
+        # set once warm_up() has run every inference shape once
+        self.ready = False
 
     def init_face_app(self):
-        """Initialize InsightFace once."""
-        if self.fa is None:
-            ctx_id = 0 if self.use_gpu else -1
-            print(f"[FaceService] Initializing FaceAnalysis (ctx_id={ctx_id}, det_size={self.det_size})")
-            self.fa = FaceAnalysis(allowed_modules=['detection','recognition'])
-            self.fa.prepare(ctx_id=ctx_id, det_size=self.det_size)
+        """
+        Initialize InsightFace once. Thread-safe: concurrent first callers wait
+        for the single load instead of each building their own FaceAnalysis.
+        """
+        if self.fa is not None:
+            return
+        with self._init_lock:
+            if self.fa is not None:
+                return
+            det_providers = resolve_providers(self.det_session_options, self.use_gpu)
+            rec_providers = resolve_providers(self.rec_session_options, self.use_gpu)
+            print(f"[FaceService] Initializing FaceAnalysis (model={self.model_name}, "
+                  f"det_size={self.det_size}, enroll_det_size={self.enroll_det_size}, det_thresh={self.det_conf_threshold})")
+            # static_shape_sessions=False: SCRFD would otherwise build a separate
+            # fixed-shape ORT session per input size (adaptive / enroll / coarse /
+            # tile sizes); with False they all run on the one dynamic session
+            separate_rec = self.rec_session_options != self.det_session_options or rec_providers != det_providers
+            fa = FaceAnalysis(name=self.model_name,
+                              allowed_modules=['detection'] if separate_rec else ['detection','recognition'],
+                              providers=det_providers,
+                              sess_options=make_session_options(self.det_session_options),
+                              static_shape_sessions=False)
+            if separate_rec:
+                # recognizer with its own options, built once instead of loaded by FaceAnalysis and rebuilt
+                rec_file = self._recognition_model_file(fa)
+                fa.models["recognition"] = ArcFaceONNX(
+                    model_file=rec_file,
+                    session=onnxruntime.InferenceSession(
+                        rec_file,
+                        sess_options=make_session_options(self.rec_session_options),
+                        providers=rec_providers,
+                    ),
+                )
+            rec = fa.models["recognition"]
+            # providers are already chosen above; ctx_id < 0 would reset them to CPU
+            fa.prepare(ctx_id=0, det_thresh=self.det_conf_threshold, det_size=self.det_size)
+            print(f"[FaceService] ORT detection  : {describe_session(fa.det_model.session)}")
+            print(f"[FaceService] ORT recognition: {describe_session(rec.session)}")
+            # publish only the fully prepared instance
+            self.fa = fa
             print("[FaceService] FaceAnalysis ready.")
 
-    def build_embeddings_for_students(self, roll_ids: List[str]):
+    @staticmethod
+    def _recognition_model_file(fa: FaceAnalysis) -> str:
+        """ONNX file of the pack's recognition model, found the way insightface's model router does."""
+        package = getattr(fa, "model_package", None)
+        if package is not None:
+            return str(package.task("recognition").path)
+        for path in sorted(glob.glob(os.path.join(fa.model_dir, "*.onnx"))):
+            graph = onnx.load(path, load_external_data=False).graph
+            weights = {init.name for init in graph.initializer}
+            inputs = [i for i in graph.input if i.name not in weights]
+            if len(inputs) != 1 or len(graph.output) >= 5:  # swapper / detector
+                continue
+            dims = [d.dim_value for d in inputs[0].type.tensor_type.shape.dim]
+            # 192 = landmark, 96 = gender/age; recognition inputs are square, >= 112, multiple of 16
+            if len(dims) == 4 and dims[2] == dims[3] and dims[2] >= 112 and dims[2] % 16 == 0 and dims[2] != 192:
+                return path
+        raise RuntimeError(f"No recognition model found in {fa.model_dir}")
+
+    def warm_up(self):
         """
-        Build face embeddings ONLY for the requested roll numbers.
-        Returns:
-            student_names: List[str] of roll_ids
-            student_embs: np.ndarray embeddings
+        Load the models and run one dummy inference per input shape used at
+        request time, so ONNX Runtime's graph optimization and first-run
+        allocations happen before the first real request. Sets self.ready.
         """
+        t0 = time.perf_counter()
         self.init_face_app()
-        all_file_paths = self.supa.list_all_files_recursive(self.student_bucket)
 
-        # Map roll_id → images in bucket
-        roll_to_images = defaultdict(list)
-        for p in all_file_paths:
-            if "/" in p:
-                folder = p.split("/")[0].lower().strip()
-                if folder in roll_ids:
-                    roll_to_images[folder].append(p)
+        sizes = {tuple(self.det_size)}
+        if self.enroll_det_size:
+            sizes.add(tuple(self.enroll_det_size))
+        if self.det_mode == "adaptive":
+            sizes.update((s, s) for s in self.det_sizes)
+        if self.det_mode == "coarse_to_fine":
+            sizes.add((self.coarse_det_size, self.coarse_det_size))
+        if self.det_mode in ("tiled", "coarse_to_fine") or self.roi_registry is not None:
+            sizes.add((self.tile_size, self.tile_size))
+        for w, h in sizes:
+            self._detect_faces(np.zeros((h, w, 3), dtype=np.uint8), input_size=(w, h))
+
+        rec = self.fa.models["recognition"]
+        crop = np.zeros((rec.input_size[1], rec.input_size[0], 3), dtype=np.uint8)
+        rec.get_feat([crop] * self._rec_batch_size(rec))
+
+        self.ready = True
+        print(f"[FaceService] Warm-up done in {time.perf_counter() - t0:.1f}s (det sizes {sorted(sizes)})")
+
+    def close(self):
+        """Shut down the shared enrollment / listing pools (app shutdown)."""
+        for pool in (self._io_pool, self._decode_pool, self._list_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def build_embeddings_for_students(self, roll_ids: List[str]) -> Gallery:
+        """
+        Build face embeddings ONLY for the requested roll numbers.
+        Returns a Gallery (normalized matrix + int32 student labels), students
+        in roll_ids order.
+        """
+        blocks, missing = self._cached_blocks(roll_ids)
+
+        if missing:
+            blocks.update(self._build_missing_blocks(missing))
 
-        names = []
-        embs = []
+        return self._assemble_gallery(roll_ids, blocks, missing)
+
+    async def build_embeddings_for_students_async(self, roll_ids: List[str], executor) -> Gallery:
+        """
+        Async variant of build_embeddings_for_students: photos are downloaded
+        with the async HTTP client and only decode/detect/embed is handed to
+        `executor` (the bounded inference pool).
+        """
+        blocks, missing = await asyncio.to_thread(self._cached_blocks, roll_ids)
+
+        if missing:
+            blocks.update(await self._build_missing_blocks_async(missing, executor))
+
+        return self._assemble_gallery(roll_ids, blocks, missing)
+
+    def _build_missing_blocks(self, roll_ids: List[str]) -> Dict[str, np.ndarray]:
+        """Build (and cache) blocks, joining builds of the same rolls already in progress."""
+        def build(keys):
+            rids = [rid for _, rid in keys]
+            tags = self._block_tags(rids)
+            built = self._build_student_blocks(rids)
+            self._cache_blocks(built, tags)
+            return {(self.student_bucket, rid): block for rid, block in built.items()}
+
+        results = self.single_flight.run([(self.student_bucket, rid) for rid in roll_ids], build)
+        return {rid: block for (_, rid), block in results.items()}
+
+    async def _build_missing_blocks_async(self, roll_ids: List[str], executor) -> Dict[str, np.ndarray]:
+        async def build(keys):
+            rids = [rid for _, rid in keys]
+            tags = await asyncio.to_thread(self._block_tags, rids)
+            built = await self._build_student_blocks_async(rids, executor)
+            self._cache_blocks(built, tags)
+            return {(self.student_bucket, rid): block for rid, block in built.items()}
+
+        results = await self.single_flight.run_async([(self.student_bucket, rid) for rid in roll_ids], build)
+        return {rid: block for (_, rid), block in results.items()}
+
+    def _cached_blocks(self, roll_ids: List[str]) -> Tuple[Dict[str, np.ndarray], List[str]]:
+        """Blocks served from the gallery cache, and the roll IDs that still need building."""
+        cache = self.gallery_cache
+        blocks: Dict[str, np.ndarray] = {}
+
+        if self.bucket_index is not None:
+            self.bucket_index.sync(self.supa, self.student_bucket, roll_ids, executor=self._list_pool)
+
+        if cache is None:
+            return blocks, list(roll_ids)
+
+        # a block built from an older generation of the roll's photos is a miss,
+        # whichever process noticed the change
+        tags = self._block_tags(roll_ids)
+        missing = []
+        stale = []
+        for rid in roll_ids:
+            block, is_stale = cache.get(rid, tag=tags.get(rid))
+            if block is None:
+                missing.append(rid)
+                continue
+            blocks[rid] = block
+            if is_stale:
+                stale.append(rid)
+        if stale:
+            publish = self.gallery_snapshots.update_students if self.gallery_snapshots is not None else None
+            cache.refresh_async(stale, self._refresh_student_blocks, on_refreshed=publish)
+        return blocks, missing
+
+    def _refresh_student_blocks(self, roll_ids: List[str]) -> Dict[str, Tuple[Optional[np.ndarray], Optional[int]]]:
+        """
+        Background refresh of stale blocks, through single_flight so it shares
+        builds with concurrent requests. Returns {rid: (block or None, tag)}
+        for the rolls it built itself; the cache stores them (and publishes
+        new gallery versions) unless the entry changed in the meantime.
+        """
+        refreshed = {}
+
+        def build(keys):
+            rids = [rid for _, rid in keys]
+            tags = self._block_tags(rids)
+            built = self._build_student_blocks(rids)
+            refreshed.update((rid, (built.get(rid), tags.get(rid))) for rid in rids)
+            return {(self.student_bucket, rid): block for rid, block in built.items()}
+
+        self.single_flight.run([(self.student_bucket, rid) for rid in roll_ids], build)
+        return refreshed
+
+    def _block_tags(self, roll_ids: List[str]) -> Dict[str, int]:
+        """Bucket index generation of each roll, read before building from its photos."""
+        if self.bucket_index is None:
+            return {}
+        return self.bucket_index.generations(self.student_bucket, roll_ids)
+
+    def _cache_blocks(self, built: Dict[str, np.ndarray], tags: Dict[str, int]):
+        if self.gallery_cache is not None:
+            for rid, block in built.items():
+                self.gallery_cache.put(rid, block, tag=tags.get(rid))
+
+    def _assemble_gallery(self, roll_ids: List[str], blocks: Dict[str, np.ndarray], missing: List[str]) -> Gallery:
+        # keep the original order: roll_ids order, then photo order per student
+        ordered = [rid for rid in roll_ids if rid in blocks]
+        if not ordered:
+            raise RuntimeError("No embeddings created for requested roll numbers.")
+
+        if self.gallery_snapshots is not None:
+            key = GallerySnapshots.roster_key(roll_ids)
+            gallery = self.gallery_snapshots.resolve(key, {rid: blocks[rid] for rid in ordered})
+        else:
+            gallery = Gallery.from_blocks((rid, blocks[rid]) for rid in ordered)
+
+        print(f"[FaceService] Built {len(gallery)} embeddings for students: {roll_ids} "
+              f"({len(roll_ids) - len(missing)} from cache, gallery v{gallery.version})")
+
+        return gallery
+
+    def _build_student_blocks(self, roll_ids: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Compute per-student blocks of normalized embeddings (k x D) from the
+        bucket, reusing the on-disk embedding store where possible.
+        Students without any usable photo are left out.
+        """
+        slots, tasks = self._plan_student_blocks(roll_ids)
+
+        computed = {}
+        for i, task, downloaded, emb in self._run_enrollment_pipeline(tasks):
+            if downloaded:
+                computed[i] = emb
+
+        return self._finish_student_blocks(slots, tasks, computed)
+
+    async def _build_student_blocks_async(self, roll_ids: List[str], executor) -> Dict[str, np.ndarray]:
+        slots, tasks = await asyncio.to_thread(self._plan_student_blocks, roll_ids)
+
+        loop = asyncio.get_running_loop()
+        # same bounds as the threaded pipeline: at most enroll_pipeline_depth photos
+        # in flight (downloaded bytes held until their embedding is done), of which
+        # at most enroll_io_workers are downloading
+        in_flight = asyncio.Semaphore(max(1, self.enroll_pipeline_depth))
+        downloads = asyncio.Semaphore(max(1, self.enroll_io_workers))
+
+        async def compute(task):
+            _, p, _ = task
+            async with in_flight:
+                async with downloads:
+                    img_bytes = await self.supa.download_bytes_async(self.student_bucket, p)
+                if not img_bytes:
+                    print(f"[WARN] Could not download {p}")
+                    return False, None
+                return True, await loop.run_in_executor(executor, self._embed_reference_bytes, p, img_bytes)
+
+        results = await asyncio.gather(*(compute(t) for t in tasks))
+        computed = {i: emb for i, (downloaded, emb) in enumerate(results) if downloaded}
+
+        return await asyncio.to_thread(self._finish_student_blocks, slots, tasks, computed)
+
+    def _plan_student_blocks(self, roll_ids: List[str]):
+        """
+        List each student's photos and split them into embedding-store hits and
+        tasks to compute. Returns (slots, tasks): slots keep the listing order,
+        each holding an embedding (hit) or an index into tasks.
+        """
+        self.init_face_app()
+        roll_to_images = self._list_student_images(roll_ids)
+
+        store = self.embedding_store
+        slots = []
+        tasks = []
 
         for rid in roll_ids:
             imgs = roll_to_images.get(rid, [])
@@ -63,94 +404,482 @@ class FaceService:
                 print(f"[WARN] No images found for {rid}")
                 continue
 
-            for p in imgs:
-                img_bytes = self.supa.download_bytes(self.student_bucket, p)
-                if not img_bytes:
-                    print(f"[WARN] Could not download {p}")
-                    continue
+            for obj in imgs:
+                p = obj["path"]
+                version = obj.get("etag") or obj.get("updated_at") or ""
 
-                img_bgr = bytes_to_bgr_image(img_bytes)
-                if img_bgr is None:
-                    print(f"[WARN] Cannot decode {p}")
-                    continue
+                if store is not None:
+                    hit, emb = store.lookup(rid, p, version)
+                    if hit:
+                        if emb is not None:
+                            slots.append((rid, emb))
+                        continue
+
+                slots.append((rid, len(tasks)))
+                tasks.append((rid, p, version))
+
+        # one bulk signing call instead of one per photo
+        self.supa.presign(self.student_bucket, [p for _, p, _ in tasks])
+
+        return slots, tasks
+
+    def _finish_student_blocks(self, slots, tasks, computed: Dict[int, Optional[np.ndarray]]) -> Dict[str, np.ndarray]:
+        """Persist newly computed embeddings and stack per-student blocks in listing order."""
+        store = self.embedding_store
+        if store is not None:
+            for i, emb in computed.items():
+                rid, p, version = tasks[i]
+                store.put(rid, p, version, emb)
+            store.flush()
+
+        if tasks:
+            print(f"[FaceService] Computed {len(computed)} new reference embeddings")
 
-                img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-                faces = self.fa.get(img_rgb)
-                if not faces:
-                    print(f"[WARN] No face detected in {p}")
+        student_embs = defaultdict(list)
+        for rid, slot in slots:
+            emb = computed.get(slot) if isinstance(slot, int) else slot
+            if emb is not None:
+                student_embs[rid].append(emb)
+
+        return {rid: np.vstack(e).astype(np.float32) for rid, e in student_embs.items()}
+
+    def _run_enrollment_pipeline(self, tasks: List[Tuple[str, str, str]]):
+        """
+        Staged enrollment: downloads run on an I/O pool, decoding on a decode
+        pool (cv2 releases the GIL) and inference here, in task order.
+        At most pipeline_depth photos are in flight, which keeps memory flat.
+        Yields (index, task, downloaded, embedding_or_None).
+        """
+        if not tasks:
+            return
+
+        io_pool = self._io_pool
+        decode_pool = self._decode_pool
+
+        def fetch(task):
+            _, p, _ = task
+            img_bytes = self.supa.download_bytes(self.student_bucket, p)
+            if not img_bytes:
+                return None
+            return decode_pool.submit(self._decode_reference_image, p, img_bytes)
+
+        window = deque()
+        try:
+            pending = iter(enumerate(tasks))
+            for i, task in islice(pending, max(1, self.enroll_pipeline_depth)):
+                window.append((i, task, io_pool.submit(fetch, task)))
+
+            while window:
+                i, task, fut = window.popleft()
+                nxt = next(pending, None)
+                if nxt is not None:
+                    window.append((nxt[0], nxt[1], io_pool.submit(fetch, nxt[1])))
+
+                try:
+                    decode_fut = fut.result()
+                except Exception as e:
+                    print(f"[WARN] Download error for {task[1]}: {e}")
+                    decode_fut = None
+                if decode_fut is None:
+                    print(f"[WARN] Could not download {task[1]}")
+                    yield i, task, False, None
                     continue
 
-                face = max(faces, key=lambda f: (f.bbox[2]-f.bbox[0])*(f.bbox[3]-f.bbox[1]))
-                emb = np.asarray(face.embedding, dtype=np.float32)
-                emb = emb / (np.linalg.norm(emb) + 1e-10)
+                img_rgb = decode_fut.result()
+                emb = self._embed_reference_rgb(task[1], img_rgb) if img_rgb is not None else None
+                yield i, task, True, emb
+        finally:
+            # abandoned early: drop this build's queued work, the pools are shared
+            for _, _, fut in window:
+                if not fut.cancel() and fut.done() and fut.exception() is None and fut.result() is not None:
+                    fut.result().cancel()
 
-                names.append(rid)
-                embs.append(emb)
+    def _list_student_images(self, roll_ids: List[str]) -> Dict[str, List[Dict]]:
+        """
+        Map roll_id → image objects in the student bucket.
+        With a bucket index this is a local query (the index is synced in
+        build_embeddings_for_students).
+        "prefix" mode lists only the <roll_id>/ folders (in parallel), so the
+        cost follows class size, falling back to a case-insensitive folder
+        lookup for rolls that come back empty; "full" walks the whole bucket
+        and filters.
+        """
+        if self.bucket_index is not None:
+            return self.bucket_index.objects_for_rolls(self.student_bucket, roll_ids)
 
-        if not embs:
-            raise RuntimeError("No embeddings created for requested roll numbers.")
+        roll_to_images = defaultdict(list)
+
+        if self.listing_mode == "prefix":
+            listings = self.supa.list_objects_for_prefixes(self.student_bucket, roll_ids, executor=self._list_pool)
+            for rid, objs in listings.items():
+                roll_to_images[rid].extend(objs)
+            # prefixes are case-sensitive: find folders like "ABC123/" for empty rolls
+            empty = [rid for rid in roll_ids if not roll_to_images.get(rid)]
+            if empty:
+                folders = self.supa.find_folders(self.student_bucket, empty)
+                by_folder = {f: rid for rid, names in folders.items() for f in names if f != rid}
+                if by_folder:
+                    listings = self.supa.list_objects_for_prefixes(self.student_bucket, list(by_folder), executor=self._list_pool)
+                    for folder, objs in listings.items():
+                        roll_to_images[by_folder[folder]].extend(objs)
+            return roll_to_images
+
+        all_objects = self.supa.list_all_objects_recursive(self.student_bucket)
+        for obj in all_objects:
+            p = obj["path"]
+            if "/" in p:
+                folder = p.split("/")[0].lower().strip()
+                if folder in roll_ids:
+                    roll_to_images[folder].append(obj)
+        return roll_to_images
 
-        names_arr = np.array(names)
-        embs_arr = np.vstack(embs).astype(np.float32)
+    def cache_stats(self) -> Dict[str, Dict]:
+        stats = {"single_flight": self.single_flight.stats()}
+        if self.gallery_cache is not None:
+            stats["gallery_cache"] = self.gallery_cache.stats()
+        if self.gallery_snapshots is not None:
+            stats["gallery_snapshots"] = self.gallery_snapshots.stats()
+        if self.embedding_store is not None:
+            stats["embedding_store"] = {"embeddings": len(self.embedding_store)}
+        return stats
 
-        print(f"[FaceService] Built {len(embs_arr)} embeddings for students: {roll_ids}")
+    def _decode_reference_image(self, p: str, img_bytes: bytes) -> Optional[np.ndarray]:
+        # portraits are detected at enroll_det_size, so that is what the reduced decode must cover
+        img_bgr, _ = decode_image_for_detection(img_bytes, self.enroll_det_size or self.det_size,
+                                                self.enroll_decode_min_face_px)
+        if img_bgr is None:
+            print(f"[WARN] Cannot decode {p}")
+            return None
+        return cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+
+    def _embed_reference_bytes(self, p: str, img_bytes: bytes) -> Optional[np.ndarray]:
+        img_rgb = self._decode_reference_image(p, img_bytes)
+        return self._embed_reference_rgb(p, img_rgb) if img_rgb is not None else None
+
+    def _embed_reference_rgb(self, p: str, img_rgb: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Normalized embedding of the largest face in one enrollment photo,
+        or None if it has no face.
+        """
+        # portraits: the small enrollment detector input is plenty
+        faces = self._detect_faces(img_rgb, input_size=self.enroll_det_size)
+        if not faces:
+            print(f"[WARN] No face detected in {p}")
+            return None
+
+        # only the largest face is used, so only that one goes through recognition
+        face = max(faces, key=lambda f: (f.bbox[2]-f.bbox[0])*(f.bbox[3]-f.bbox[1]))
+        self._embed_faces(img_rgb, [face])
+        if face.embedding is None:
+            print(f"[WARN] No face detected in {p}")
+            return None
+        emb = np.asarray(face.embedding, dtype=np.float32)
+        return emb / (np.linalg.norm(emb) + 1e-10)
+
+    def _detect_faces(self, img: np.ndarray, input_size: Optional[Tuple[int, int]] = None) -> List[Face]:
+        """
+        Run only the detector (same call FaceAnalysis.get makes) and wrap results as Face objects.
+        input_size overrides the prepared det_size for this call (same session, so the
+        recognition model and detector weights are shared); ignored for static-shape detectors.
+        """
+        if input_size is not None and not self._det_input_is_dynamic():
+            input_size = None
+        bboxes, kpss = self.fa.det_model.detect(img, input_size=input_size, max_num=0, metric='default')
+        return self._faces_from_dets(bboxes, kpss)
+
+    @staticmethod
+    def _faces_from_dets(bboxes: np.ndarray, kpss: Optional[np.ndarray]) -> List[Face]:
+        faces = []
+        for i in range(bboxes.shape[0]):
+            kps = kpss[i] if kpss is not None else None
+            faces.append(Face(bbox=bboxes[i, 0:4], kps=kps, det_score=bboxes[i, 4]))
+        return faces
 
-        return names_arr, embs_arr
+    def _det_input_is_dynamic(self) -> bool:
+        shape = getattr(self.fa.det_model, "input_shape", None)
+        return shape is None or len(shape) < 4 or not isinstance(shape[2], int) or not isinstance(shape[3], int)
 
-    def recognize_frame(self, frame_bytes, names_arr, embs_arr):
+    def _detect_tiled(self, img: np.ndarray) -> List[Face]:
         """
-        Recognize faces in a frame (bytes) against enrolled embeddings.
+        Tiled detection for large frames: overlapping tile_size tiles at full
+        resolution (plus the whole frame at tile_size for faces too large for
+        the overlap), detected one by one and merged with cross-tile NMS.
+        Cost grows with frame area instead of with det_size squared.
+        """
+        h, w = img.shape[:2]
+        tiles = tile_grid(w, h, self.tile_size, self.tile_overlap)
+        crops = [img[y0:y1, x0:x1] for x0, y0, x1, y1 in tiles]
+        offsets = [(x0, y0) for x0, y0, _, _ in tiles]
+        if len(tiles) > 1:
+            crops.append(img)
+            offsets.append((0, 0))
+        dets, kpss = self._detect_crops(crops, offsets)
+        return self._faces_from_dets(dets, kpss)
+
+    def _detect_coarse_to_fine(self, img: np.ndarray) -> Tuple[List[Face], int]:
+        """
+        Coarse-to-fine detection: one cheap pass over the whole frame at
+        coarse_det_size, then a second pass only where the coarse pass found
+        faces smaller than refine_face_px detector pixels (back rows, crowded
+        regions; the context around each face is covered by the tile).
+
+        The second pass runs at the resolution that brings the smallest of
+        those faces up to refine_face_px (never above native), and is capped
+        at refine_max_tiles tiles: when more would be needed, the refine
+        resolution is lowered until they fit. Large faces are kept from the
+        coarse pass. Returns (faces, tiles refined).
+        """
+        h, w = img.shape[:2]
+        coarse = (self.coarse_det_size, self.coarse_det_size)
+        bboxes, kpss = self.fa.det_model.detect(
+            img, input_size=coarse if self._det_input_is_dynamic() else None, max_num=0, metric='default')
+
+        # coarse-pass scale (detector resizes the frame to fit coarse_det_size)
+        scale = min(self.coarse_det_size / h, self.coarse_det_size / w, 1.0)
+        sides = np.minimum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1])
+        small = bboxes[sides * scale < self.refine_face_px]
+        if scale >= 1.0 or small.shape[0] == 0:
+            return self._faces_from_dets(bboxes, kpss), 0
+
+        # regions around small faces (native pixels), grown by one face size for context
+        pad = np.maximum(small[:, 2] - small[:, 0], small[:, 3] - small[:, 1])[:, None]
+        regions = np.hstack([np.maximum(small[:, :2] - pad, 0), small[:, 2:4] + pad])
+        refine = min(1.0, self.refine_face_px / max(1.0, float(sides[sides * scale < self.refine_face_px].min())))
+        while True:
+            sw, sh = int(round(w * refine)), int(round(h * refine))
+            r = regions * refine
+            tiles = [
+                t for t in tile_grid(sw, sh, self.tile_size, self.tile_overlap)
+                if np.any((r[:, 0] < t[2]) & (r[:, 2] > t[0]) & (r[:, 1] < t[3]) & (r[:, 3] > t[1]))
+            ]
+            if len(tiles) <= max(1, self.refine_max_tiles):
+                break
+            refine *= 0.8
+        if refine <= scale * 1.1:
+            # no meaningful gain over the coarse pass
+            return self._faces_from_dets(bboxes, kpss), 0
+
+        crops, offsets = [], []
+        for x0, y0, x1, y1 in tiles:
+            nx0, ny0 = int(x0 / refine), int(y0 / refine)
+            nx1, ny1 = min(w, int(np.ceil(x1 / refine))), min(h, int(np.ceil(y1 / refine)))
+            crop = img[ny0:ny1, nx0:nx1]
+            if refine < 1.0:
+                crop = cv2.resize(crop, None, fx=refine, fy=refine, interpolation=cv2.INTER_AREA)
+            crops.append(crop)
+            offsets.append((nx0, ny0))
+        dets, kps = self._detect_crops(crops, offsets, extra=(bboxes, kpss), scale=refine)
+        return self._faces_from_dets(dets, kps), len(tiles)
+
+    def _detect_roi(self, img: np.ndarray, geo: RoomGeometry) -> List[Face]:
+        """
+        Detection restricted to a room's seat areas: the cached ROI tiles are
+        sliced as views of the frame, detected one by one, and only faces whose
+        centre lies inside an ROI polygon are kept.
+        """
+        if not geo.tiles:
+            return []
+        crops = [img[y0:y1, x0:x1] for x0, y0, x1, y1 in geo.tiles]
+        offsets = [(x0, y0) for x0, y0, _, _ in geo.tiles]
+        dets, kpss = self._detect_crops(crops, offsets)
+        inside = np.array(
+            [geo.contains((d[0] + d[2]) / 2, (d[1] + d[3]) / 2) for d in dets], dtype=bool
+        ).reshape(-1)
+        return self._faces_from_dets(dets[inside], kpss[inside] if kpss is not None else None)
+
+    def _detect_crops(self, crops: List[np.ndarray], offsets: List[Tuple[int, int]], extra=None,
+                      scale: float = 1.0):
+        """
+        Detection on crops at tile_size, shifted back to frame coordinates and
+        merged with cross-crop NMS. Crops resized by `scale` relative to the
+        frame have their boxes divided by it before the shift. `extra` is an
+        optional (bboxes, kpss) already in frame coordinates to merge in.
+
+        Crops go through SCRFD.detect one at a time: the buffalo_l det_10g
+        export has no batch axis on its outputs, so batching tiles into one
+        run would need a detector re-exported with a dynamic batch dimension.
+        """
+        dets_list, kpss_list = [], []
+        if extra is not None and extra[0].shape[0]:
+            dets_list.append(extra[0])
+            if extra[1] is not None:
+                kpss_list.append(extra[1])
+        input_size = (self.tile_size, self.tile_size) if self._det_input_is_dynamic() else None
+        for crop, (x0, y0) in zip(crops, offsets):
+            bboxes, kpss = self.fa.det_model.detect(crop, input_size=input_size, max_num=0, metric='default')
+            if bboxes.shape[0] == 0:
+                continue
+            bboxes = bboxes.copy()
+            bboxes[:, :4] /= scale
+            bboxes[:, [0, 2]] += x0
+            bboxes[:, [1, 3]] += y0
+            dets_list.append(bboxes)
+            if kpss is not None:
+                kpss_list.append(kpss / scale + np.array([x0, y0], dtype=np.float32))
+
+        if not dets_list:
+            return np.empty((0, 5), dtype=np.float32), None
+        dets = np.vstack(dets_list)
+        kpss = np.vstack(kpss_list) if len(kpss_list) == len(dets_list) else None
+        return merge_detections(dets, kpss, iou_thresh=getattr(self.fa.det_model, "nms_thresh", 0.4))
+
+    def _rec_batch_size(self, rec) -> int:
+        if isinstance(rec.input_shape[0], int) and rec.input_shape[0] > 0:
+            # model exported with a static batch dimension
+            return rec.input_shape[0]
+        return max(1, self.rec_batch_size)
+
+    def _embed_faces(self, img: np.ndarray, faces: List[Face]):
+        """
+        Batched recognition: align every face crop, stack them into one
+        (N,3,112,112) blob and run the recognition session in chunks of
+        rec_batch_size instead of once per face. Sets face.embedding in place.
+        """
+        rec = self.fa.models["recognition"]
+        faces = [f for f in faces if f.kps is not None]
+        if not faces:
+            return
+
+        batch_size = self._rec_batch_size(rec)
+        crops = [face_align.norm_crop(img, landmark=f.kps, image_size=rec.input_size[0]) for f in faces]
+        for start in range(0, len(crops), batch_size):
+            feats = rec.get_feat(crops[start:start + batch_size])
+            for face, feat in zip(faces[start:start + batch_size], feats):
+                face.embedding = feat.flatten()
+
+    def recognize_frame(self, frame_bytes, gallery: Gallery):
+        """
+        Recognize faces in a frame (bytes) against an enrolled gallery.
+        """
+        faces, _ = self.detect_frame(frame_bytes)
+        return self.match_faces(faces, gallery)
+
+    def detect_frame(self, frame_bytes, det_size_hint: Optional[int] = None,
+                     room_id: Optional[str] = None) -> Tuple[List[Face], Dict[str, int]]:
+        """
+        Decode a frame and return its faces with embeddings, plus detection
+        stats. Independent of the gallery, so it can run while the gallery is
+        being built. Faces below det_conf_threshold or smaller than
+        min_face_size are pruned before recognition.
+        det_size_hint: optional per-request detector size (adaptive mode).
+        room_id: restrict detection to the room's registered ROIs (any mode).
         """
 
         # Make sure face analysis is initialized
         self.init_face_app()
 
-        # Step 1: Decode image bytes
-        nparr = np.frombuffer(frame_bytes, np.uint8)
-        img_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        if room_id is not None and (self.roi_registry is None or room_id not in self.roi_registry):
+            raise KeyError(f"No ROIs registered for room {room_id}")
+        mode = "roi" if room_id is not None else self.det_mode
+
+        # Detector input: chosen from the header dimensions when possible, so the decode can use it too
+        info = read_image_size(frame_bytes)
+        det_size = self.det_size
+        if mode == "adaptive" and info is not None:
+            det_size = self.choose_det_size(info[1], info[2], det_size_hint)
+
+        # Step 1: Decode image bytes (reduced-resolution decode when the frame is far above det_size;
+        # tiled, coarse-to-fine and ROI modes work on the full-resolution frame)
+        if mode in ("tiled", "coarse_to_fine", "roi"):
+            img_bgr, factor = bytes_to_bgr_image(frame_bytes), 1
+        else:
+            img_bgr, factor = decode_image_for_detection(frame_bytes, det_size, self.decode_min_face_px)
         if img_bgr is None:
             raise ValueError("Could not decode image bytes")
 
+        if mode == "adaptive" and info is None:
+            h, w = img_bgr.shape[:2]
+            det_size = self.choose_det_size(w * factor, h * factor, det_size_hint)
+
         img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
 
-        # Step 2: Face detection using InsightFace
-        faces = self.fa.get(img_rgb)
-        if not faces:
-            # No faces → everyone absent with 0 similarity
-            return [], {str(n): 0.0 for n in names_arr}
+        # Step 2: Face detection using InsightFace, pruning, then batched recognition
+        extra_stats = {}
+        if mode == "roi":
+            h, w = img_rgb.shape[:2]
+            geo = self.roi_registry.geometry(room_id, w, h, self.tile_size, self.tile_overlap)
+            detected = self._detect_roi(img_rgb, geo)
+            det_size = (self.tile_size, self.tile_size)
+            extra_stats["roi_tiles"] = len(geo.tiles)
+        elif mode == "tiled":
+            detected = self._detect_tiled(img_rgb)
+            det_size = (self.tile_size, self.tile_size)
+        elif mode == "coarse_to_fine":
+            detected, extra_stats["refined_tiles"] = self._detect_coarse_to_fine(img_rgb)
+            det_size = (self.coarse_det_size, self.coarse_det_size)
+        else:
+            detected = self._detect_faces(img_rgb, input_size=det_size if det_size != self.det_size else None)
+        faces = self._prune_faces(detected, scale=factor)
+        self._embed_faces(img_rgb, faces)
 
-        # Convert reference embeddings to numpy
-        names_list = list(names_arr)
-        ref_embs = np.asarray(embs_arr, dtype=np.float32)
+        stats = {
+            "faces_detected": len(detected),
+            "faces_pruned": len(detected) - len(faces),
+            "det_size": int(det_size[0]),
+            **extra_stats,
+        }
+        if stats["faces_pruned"]:
+            print(f"[FaceService] Pruned {stats['faces_pruned']}/{stats['faces_detected']} faces "
+                  f"(det_score < {self.det_conf_threshold} or size < {self.min_face_size}px)")
+        return faces, stats
 
-        # Normalize reference embeddings
-        ref_embs = ref_embs / (np.linalg.norm(ref_embs, axis=1, keepdims=True) + 1e-10)
+    def choose_det_size(self, width: int, height: int, hint: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Adaptive detector input from the pre-set det_sizes:
+          - a per-request hint wins (snapped to the nearest size >= hint)
+          - otherwise the smallest size that still shows a face of
+            expected_face_px at >= MIN_DET_FACE_PX detector pixels,
+            or det_size when the face size is unknown
+          - never larger than needed to cover the frame (no upscaling work)
+        """
+        def snap(target):
+            for size in self.det_sizes:
+                if size >= target:
+                    return size
+            return self.det_sizes[-1]
 
-        # Track similarity scores
-        max_sims = {str(n): 0.0 for n in names_list}
+        if hint:
+            size = snap(hint)
+            return (size, size)
 
-        # Step 3: For each detected face
-        for face in faces:
+        longest = max(width, height)
+        if self.expected_face_px > 0:
+            target = MIN_DET_FACE_PX * longest / self.expected_face_px
+        else:
+            target = max(self.det_size)
+        size = min(snap(target), snap(longest))
+        return (size, size)
 
-            emb = np.asarray(face.embedding, dtype=np.float32)
-            if emb.size == 0:
+    def _prune_faces(self, faces: List[Face], scale: float = 1.0) -> List[Face]:
+        """
+        Drop low-confidence and tiny detections so they never reach recognition.
+        scale converts bbox pixels back to original-image pixels (reduced decode).
+        """
+        kept = []
+        for f in faces:
+            if float(f.det_score) < self.det_conf_threshold:
                 continue
+            w, h = (f.bbox[2] - f.bbox[0]) * scale, (f.bbox[3] - f.bbox[1]) * scale
+            if min(w, h) < self.min_face_size:
+                continue
+            kept.append(f)
+        return kept
 
-            emb = emb / (np.linalg.norm(emb) + 1e-10)
-
-            sims = np.dot(ref_embs, emb)
-
-            for i, name in enumerate(names_list):
-                sim = float(sims[i])
-                if sim > max_sims[str(name)]:
-                    max_sims[str(name)] = sim
-
-        # Step 4: Filter recognized based on threshold
-        recognized = [
-            name for name, sim in max_sims.items()
-            if sim >= float(self.sim_threshold)
+    def match_faces(self, faces: List[Face], gallery: Gallery) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Match detected faces (from detect_frame) against a gallery.
+        Returns (recognized student ids, best similarity per student id, total present);
+        ids index gallery.names.
+        """
+        frame_embs = [
+            np.asarray(face.embedding, dtype=np.float32).ravel()
+            for face in faces
+            if face.embedding is not None and np.size(face.embedding) > 0
         ]
-        total_present = len(recognized)
 
-        return recognized, max_sims,total_present
+        # No faces → everyone absent with 0 similarity
+        scores = gallery.best_scores(np.vstack(frame_embs) if frame_embs else frame_embs)
 
+        # Filter recognized based on threshold (ids of removed students never score)
+        recognized = np.flatnonzero(scores >= float(self.sim_threshold)).astype(np.int32)
+        return recognized, scores, len(recognized)
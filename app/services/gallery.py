@@ -0,0 +1,289 @@
+# app/services/gallery.py
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+def _grouped_max(values: np.ndarray, labels: np.ndarray, n_groups: int) -> np.ndarray:
+    """Max of values per integer label (labels in [0, n_groups)); -inf for labels without rows."""
+    out = np.full(n_groups, -np.inf, dtype=values.dtype)
+    if values.size == 0:
+        return out
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    out[sorted_labels[starts]] = np.maximum.reduceat(values[order], starts)
+    return out
+
+
+class Gallery:
+    """
+    Enrolled reference embeddings in matching layout:
+      - matrix: contiguous (N, D) float32, rows L2-normalized once on add
+      - labels: (N,) int32 student id of each row
+      - names / ids: id -> roll_id and roll_id -> id
+
+    Students can be added or removed without rebuilding the rest: rows live
+    in a growable buffer, and removing a student moves the last rows into
+    its slots. Ids of removed students are reused.
+
+    A published Gallery (see GallerySnapshots) is frozen: it is never
+    modified again, updates go to a copy().
+    """
+
+    def __init__(self, dim: Optional[int] = None, capacity: int = 0):
+        self.dim = dim
+        self._matrix = np.empty((capacity, dim or 0), dtype=np.float32)
+        self._labels = np.empty(capacity, dtype=np.int32)
+        self._size = 0
+        self.names: List[Optional[str]] = []
+        self.ids: Dict[str, int] = {}
+        self._free_ids: List[int] = []
+        # block object each student was built from, and snapshot version
+        self.sources: Dict[str, np.ndarray] = {}
+        self.version = 0
+        self.frozen = False
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[Tuple[str, np.ndarray]]) -> "Gallery":
+        """Gallery of (roll_id, k x D block) pairs, in the given order."""
+        blocks = [(name, np.asarray(block, dtype=np.float32)) for name, block in blocks]
+        rows = sum(len(b) for _, b in blocks)
+        gallery = cls(dim=blocks[0][1].shape[1] if blocks else None, capacity=rows)
+        for name, block in blocks:
+            gallery.add(name, block)
+        return gallery
+
+    def copy(self) -> "Gallery":
+        """Unfrozen copy with its own buffers (spare capacity for a few adds)."""
+        new = Gallery(dim=self.dim, capacity=self._size + max(64, self._size // 4))
+        new._matrix[:self._size] = self.matrix
+        new._labels[:self._size] = self.labels
+        new._size = self._size
+        new.names = list(self.names)
+        new.ids = dict(self.ids)
+        new._free_ids = list(self._free_ids)
+        new.sources = dict(self.sources)
+        new.version = self.version
+        return new
+
+    def freeze(self) -> "Gallery":
+        self._matrix.setflags(write=False)
+        self._labels.setflags(write=False)
+        self.frozen = True
+        return self
+
+    # ---- views ----
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self._size]
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels[:self._size]
+
+    @property
+    def num_ids(self) -> int:
+        """Length of per-id score arrays (includes free ids)."""
+        return len(self.names)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def students(self) -> List[str]:
+        return [n for n in self.names if n is not None]
+
+    # ---- updates ----
+
+    def add(self, name: str, block: np.ndarray) -> int:
+        """Add (or replace) a student's k x D embeddings; returns the student id."""
+        if self.frozen:
+            raise RuntimeError("Gallery is published; update a copy()")
+        block = np.atleast_2d(np.asarray(block, dtype=np.float32))
+        if block.shape[1] != self.dim:
+            if self._size:
+                raise ValueError(f"Embedding dim {block.shape[1]} does not match gallery dim {self.dim}")
+            self.dim = block.shape[1]
+            self._matrix = np.empty((self._matrix.shape[0], self.dim), dtype=np.float32)
+        if name in self.ids:
+            self.remove(name)
+
+        if self._free_ids:
+            sid = self._free_ids.pop()
+            self.names[sid] = name
+        else:
+            sid = len(self.names)
+            self.names.append(name)
+        self.ids[name] = sid
+
+        self._reserve(self._size + len(block))
+        end = self._size + len(block)
+        rows = self._matrix[self._size:end]
+        rows[:] = block
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True) + 1e-10
+        self._labels[self._size:end] = sid
+        self._size = end
+        return sid
+
+    def remove(self, name: str) -> bool:
+        if self.frozen:
+            raise RuntimeError("Gallery is published; update a copy()")
+        self.sources.pop(name, None)
+        sid = self.ids.pop(name, None)
+        if sid is None:
+            return False
+        labels = self.labels
+        holes = np.flatnonzero(labels == sid)
+        keep_after = self._size - len(holes)
+        # fill holes below the new end with surviving rows from above it
+        movers = np.flatnonzero(labels[keep_after:] != sid) + keep_after
+        targets = holes[holes < keep_after]
+        self._matrix[targets] = self._matrix[movers]
+        self._labels[targets] = self._labels[movers]
+        self._size = keep_after
+        self.names[sid] = None
+        self._free_ids.append(sid)
+        return True
+
+    def _reserve(self, rows: int):
+        if rows <= self._matrix.shape[0]:
+            return
+        capacity = max(rows, 2 * self._matrix.shape[0], 64)
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        labels = np.empty(capacity, dtype=np.int32)
+        matrix[:self._size] = self._matrix[:self._size]
+        labels[:self._size] = self._labels[:self._size]
+        self._matrix, self._labels = matrix, labels
+
+    # ---- matching ----
+
+    def best_scores(self, frame_embs: np.ndarray) -> np.ndarray:
+        """
+        Best cosine similarity per student id for F x D frame embeddings,
+        clipped at 0: one F x D @ D x N matmul, then a max per label.
+        """
+        scores = np.zeros(self.num_ids, dtype=np.float32)
+        if len(frame_embs) == 0 or self._size == 0:
+            return scores
+        F = np.asarray(frame_embs, dtype=np.float32)
+        F = F / (np.linalg.norm(F, axis=1, keepdims=True) + 1e-10)
+        sims = F @ self.matrix.T                       # F x N
+        return np.maximum(_grouped_max(sims.max(axis=0), self.labels, self.num_ids), 0.0)
+
+
+class GallerySnapshots:
+    """
+    Published Gallery versions per roster, RCU-style.
+
+    - readers call current()/resolve() and match against the Gallery they
+      get without holding any lock; a published Gallery is frozen, so it
+      never changes under them
+    - writers build the next version off to the side (copy + add/remove of
+      the students whose blocks changed) and publish it by swapping the
+      roster -> Gallery map in one reference assignment; requests already
+      holding the old version finish on it
+    - writers serialize among themselves only
+
+    At most max_rosters rosters are kept (oldest published dropped first),
+    and a roster is dropped as soon as one of its students' blocks leaves the
+    gallery cache (drop_students), so a snapshot never keeps evicted blocks
+    and its own matrix alive beyond the cache's memory budget.
+    """
+
+    def __init__(self, max_rosters: int = 64):
+        self.max_rosters = max_rosters
+        self._published: Dict[Tuple[str, ...], Gallery] = {}
+        self._write_lock = threading.Lock()
+        self.reused = 0
+        self.versions = 0
+        self.dropped = 0
+
+    @staticmethod
+    def roster_key(roll_ids: Iterable[str]) -> Tuple[str, ...]:
+        return tuple(sorted(set(roll_ids)))
+
+    def current(self, key: Tuple[str, ...]) -> Optional[Gallery]:
+        return self._published.get(key)
+
+    @staticmethod
+    def _is_current(gallery: Gallery, blocks: Dict[str, np.ndarray]) -> bool:
+        return len(gallery.sources) == len(blocks) and all(
+            gallery.sources.get(rid) is block for rid, block in blocks.items()
+        )
+
+    def resolve(self, key: Tuple[str, ...], blocks: Dict[str, np.ndarray]) -> Gallery:
+        """
+        Published gallery of a roster whose students have exactly these
+        (cached, read-only) blocks; publishes a new version first if any
+        block changed.
+        """
+        gallery = self._published.get(key)
+        if gallery is not None and self._is_current(gallery, blocks):
+            self.reused += 1
+            return gallery
+
+        with self._write_lock:
+            gallery = self._published.get(key)
+            if gallery is not None and self._is_current(gallery, blocks):
+                return gallery
+            new = self._next_version(gallery, blocks)
+            self._publish({key: new})
+            return new
+
+    def update_students(self, blocks: Dict[str, np.ndarray]):
+        """Publish new versions of every roster containing a student whose block was rebuilt."""
+        with self._write_lock:
+            updates = {}
+            for key, gallery in self._published.items():
+                changed = {rid: b for rid, b in blocks.items() if rid in gallery.sources}
+                if changed:
+                    updates[key] = self._next_version(gallery, {**gallery.sources, **changed})
+            if updates:
+                self._publish(updates)
+
+    def drop_students(self, roll_ids: Iterable[str]):
+        """Unpublish every roster containing one of these students (their cached block was evicted)."""
+        roll_ids = set(roll_ids)
+        with self._write_lock:
+            published = {k: g for k, g in self._published.items() if roll_ids.isdisjoint(g.sources)}
+            if len(published) != len(self._published):
+                self.dropped += len(self._published) - len(published)
+                self._published = published
+
+    def _next_version(self, gallery: Optional[Gallery], blocks: Dict[str, np.ndarray]) -> Gallery:
+        if gallery is None:
+            new = Gallery.from_blocks(blocks.items())
+        else:
+            new = gallery.copy()
+            for rid in [r for r in new.sources if r not in blocks]:
+                new.remove(rid)
+            for rid, block in blocks.items():
+                if new.sources.get(rid) is not block:
+                    new.add(rid, block)
+        new.sources = dict(blocks)
+        new.version = (gallery.version if gallery is not None else 0) + 1
+        return new.freeze()
+
+    def _publish(self, updates: Dict[Tuple[str, ...], Gallery]):
+        # called with _write_lock held; readers see either the old or the new map
+        published = {k: g for k, g in self._published.items() if k not in updates}
+        published.update(updates)
+        while len(published) > self.max_rosters:
+            published.pop(next(iter(published)))
+        self._published = published
+        self.versions += len(updates)
+
+    def stats(self) -> Dict[str, int]:
+        published = self._published
+        return {
+            "rosters": len(published),
+            "rows": sum(len(g) for g in published.values()),
+            "versions_published": self.versions,
+            "reused": self.reused,
+            "dropped": self.dropped,
+        }
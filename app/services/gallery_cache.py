@@ -0,0 +1,193 @@
+# app/services/gallery_cache.py
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+class _Entry:
+    __slots__ = ("block", "tag", "created_at", "nbytes", "refreshing")
+
+    def __init__(self, block: np.ndarray, tag=None):
+        self.block = block
+        self.tag = tag
+        self.created_at = time.monotonic()
+        self.nbytes = block.nbytes
+        self.refreshing = False
+
+
+class GalleryCache:
+    """
+    In-memory cache of per-student embedding blocks (k x D, already normalized).
+
+    - LRU eviction once the total size of cached blocks exceeds max_bytes
+    - entries older than ttl_seconds are "stale": they are still served, and
+      the caller schedules a background refresh (stale-while-revalidate)
+    - an entry may carry a tag (e.g. the source data's generation); a get()
+      with a different tag drops it and counts as a miss
+    - hit / miss / eviction counters are exposed through stats()
+    - on_evict(keys), if set, is called (outside the lock) with keys whose
+      block left the cache other than by being replaced, so holders of
+      derived data can let go of the block too
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, refresh_workers: int = 1,
+                 on_evict: Optional[Callable[[List[str]], None]] = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix="gallery-refresh")
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def get(self, key: str, tag=None) -> Tuple[Optional[np.ndarray], bool]:
+        """Returns (block, is_stale); block is None on a miss (or a tag mismatch, if tag is given)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            outdated = entry is not None and tag is not None and entry.tag != tag
+            if outdated:
+                del self._entries[key]
+                self._bytes -= entry.nbytes
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                stale = (time.monotonic() - entry.created_at) > self.ttl_seconds
+                if stale:
+                    self.stale_hits += 1
+                else:
+                    self.hits += 1
+        if outdated:
+            self._notify_evicted([key])
+        if entry is None:
+            return None, False
+        return entry.block, stale
+
+    def put(self, key: str, block: np.ndarray, tag=None):
+        block = self._freeze(block)
+        evicted = []
+        with self._lock:
+            self._put_locked(key, block, tag, evicted)
+        self._notify_evicted(evicted)
+
+    @staticmethod
+    def _freeze(block: np.ndarray) -> np.ndarray:
+        block = np.ascontiguousarray(block, dtype=np.float32)
+        block.setflags(write=False)
+        return block
+
+    def _put_locked(self, key: str, block: np.ndarray, tag, evicted: List[str]) -> bool:
+        """Store under the lock; keys pushed out are appended to evicted. True if stored."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        if block.nbytes > self.max_bytes:
+            if old is not None:
+                evicted.append(key)
+            return False
+        self._entries[key] = _Entry(block, tag)
+        self._bytes += block.nbytes
+        while self._bytes > self.max_bytes and self._entries:
+            lru_key, lru = self._entries.popitem(last=False)
+            self._bytes -= lru.nbytes
+            self.evictions += 1
+            evicted.append(lru_key)
+        return key in self._entries
+
+    def _notify_evicted(self, keys: List[str]):
+        if keys and self.on_evict is not None:
+            try:
+                self.on_evict(keys)
+            except Exception as e:
+                print(f"[GalleryCache] on_evict failed for {keys}: {e}")
+
+    def invalidate(self, key: str):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+        if old is not None:
+            self._notify_evicted([key])
+
+    def refresh_async(self, keys: Iterable[str], build_fn: Callable[[list], Dict[str, Tuple[Optional[np.ndarray], object]]],
+                      on_refreshed: Optional[Callable[[Dict[str, np.ndarray]], None]] = None):
+        """
+        Rebuild the given (stale) keys in the background with
+        build_fn(keys) -> {key: (block or None, tag)}; None means the key no
+        longer has a block, and keys left out are left alone.
+        Keys already being refreshed are skipped; readers keep getting the old
+        block until the new one is put. A result is dropped if its entry was
+        invalidated or replaced while the build ran. on_refreshed gets the
+        blocks that were stored.
+        """
+        with self._lock:
+            todo = {}
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and not entry.refreshing:
+                    entry.refreshing = True
+                    todo[key] = entry
+        if not todo:
+            return
+
+        def _run():
+            try:
+                blocks = build_fn(list(todo))
+                stored = {}
+                evicted = []
+                with self._lock:
+                    for key, (block, tag) in blocks.items():
+                        if key not in todo or self._entries.get(key) is not todo[key]:
+                            continue
+                        if block is None:
+                            # student no longer has any usable photo
+                            del self._entries[key]
+                            self._bytes -= todo[key].nbytes
+                            evicted.append(key)
+                        else:
+                            block = self._freeze(block)
+                            if self._put_locked(key, block, tag, evicted):
+                                stored[key] = block
+                    self.refreshes += 1
+                self._notify_evicted(evicted)
+                if stored and on_refreshed is not None:
+                    on_refreshed(stored)
+            except Exception as e:
+                print(f"[GalleryCache] Background refresh failed for {list(todo)}: {e}")
+                with self._lock:
+                    self.refresh_errors += 1
+            finally:
+                with self._lock:
+                    for key in todo:
+                        entry = self._entries.get(key)
+                        if entry is not None:
+                            entry.refreshing = False
+
+        self._refresher.submit(_run)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+            }
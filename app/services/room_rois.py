@@ -0,0 +1,187 @@
+# app/services/room_rois.py
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app.utils.detection_utils import tile_grid
+
+
+class RoomGeometry:
+    """
+    ROI geometry of one room at one frame size: detector tiles (x0, y0, x1, y1)
+    covering the ROIs, and the ROI polygons used to keep only faces whose
+    centre falls inside a seat area.
+    """
+    __slots__ = ("tiles", "polygons")
+
+    def __init__(self, tiles: List[Tuple[int, int, int, int]], polygons: List[np.ndarray]):
+        self.tiles = tiles
+        self.polygons = polygons
+
+    def contains(self, x: float, y: float) -> bool:
+        return any(cv2.pointPolygonTest(p, (float(x), float(y)), False) >= 0 for p in self.polygons)
+
+
+class RoomROIRegistry:
+    """
+    Per-room regions of interest (seat rows / polygons) for fixed classroom cameras.
+
+    A room is registered with the frame size its coordinates refer to and a
+    list of ROIs, each {"rect": [x0, y0, x1, y1]} or {"polygon": [[x, y], ...]}.
+    Frames of another resolution are scaled. Geometry (tiles + polygons) is
+    computed once per (room, frame size, tile settings) and cached, so a
+    request only slices numpy views of the frame.
+
+    Registrations are persisted to a JSON file when path is set. Other worker
+    processes pick them up on their next lookup: the file is re-read whenever
+    its mtime / size changed since it was last loaded.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._rooms: Dict[str, Dict] = {}
+        self._geometry: Dict[Tuple, RoomGeometry] = {}
+        self._file_stat = None
+        with self._lock:
+            self._reload()
+        if self._rooms:
+            print(f"[RoomROIRegistry] Loaded ROIs for {len(self._rooms)} rooms from {path}")
+
+    def _reload(self):
+        """Re-read the JSON file if another process rewrote it. Called with _lock held."""
+        if not self.path:
+            return
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size) if st else None
+        if key == self._file_stat:
+            return
+        rooms = {}
+        if st is not None:
+            try:
+                with open(self.path, "r") as f:
+                    rooms = json.load(f)
+            except Exception as e:
+                print(f"[RoomROIRegistry] Ignoring unreadable {self.path}: {e}")
+                return
+        # keep cached geometry of rooms whose definition didn't change
+        self._geometry = {k: v for k, v in self._geometry.items() if rooms.get(k[0]) == self._rooms.get(k[0])}
+        self._rooms = {rid: self._rooms[rid] if self._rooms.get(rid) == room else room for rid, room in rooms.items()}
+        self._file_stat = key
+
+    @contextmanager
+    def _write_lock(self):
+        """_lock plus an flock on <path>.lock, so read-modify-write of the file is atomic across processes."""
+        with self._lock:
+            if not self.path:
+                yield
+                return
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._reload()
+                yield
+
+    @staticmethod
+    def _polygon(roi) -> List[List[float]]:
+        if not isinstance(roi, dict):
+            raise ValueError(f"ROI must be an object with 'rect' or 'polygon': {roi!r}")
+        if "rect" in roi:
+            x0, y0, x1, y1 = [float(v) for v in roi["rect"]]
+            if x1 <= x0 or y1 <= y0:
+                raise ValueError(f"Empty rect: {roi['rect']}")
+            return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+        if "polygon" in roi:
+            pts = [[float(x), float(y)] for x, y in roi["polygon"]]
+            if len(pts) < 3:
+                raise ValueError("Polygon needs at least 3 points")
+            return pts
+        raise ValueError(f"ROI must have 'rect' or 'polygon': {roi!r}")
+
+    def register(self, room_id: str, frame_width: int, frame_height: int, rois: List[Dict]) -> Dict:
+        if frame_width <= 0 or frame_height <= 0:
+            raise ValueError("frame_width and frame_height must be positive")
+        if not rois:
+            raise ValueError("At least one ROI is required")
+        room = {
+            "frame_width": int(frame_width),
+            "frame_height": int(frame_height),
+            "polygons": [self._polygon(r) for r in rois],
+        }
+        with self._write_lock():
+            self._rooms[room_id] = room
+            self._geometry = {k: v for k, v in self._geometry.items() if k[0] != room_id}
+            self._save()
+        return room
+
+    def remove(self, room_id: str) -> bool:
+        with self._write_lock():
+            found = self._rooms.pop(room_id, None) is not None
+            self._geometry = {k: v for k, v in self._geometry.items() if k[0] != room_id}
+            if found:
+                self._save()
+        return found
+
+    def get(self, room_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._reload()
+            return self._rooms.get(room_id)
+
+    def __contains__(self, room_id: str) -> bool:
+        with self._lock:
+            self._reload()
+            return room_id in self._rooms
+
+    def geometry(self, room_id: str, width: int, height: int, tile: int, overlap: int) -> Optional[RoomGeometry]:
+        """Cached tiles + polygons of a room for a frame of width x height; None for unknown rooms."""
+        key = (room_id, width, height, tile, overlap)
+        with self._lock:
+            self._reload()
+            geo = self._geometry.get(key)
+            room = self._rooms.get(room_id)
+        if geo is not None or room is None:
+            return geo
+
+        sx, sy = width / room["frame_width"], height / room["frame_height"]
+        # crops extend past the ROI a little so faces on its border are not cut
+        pad = overlap // 2
+        polygons, tiles = [], []
+        for pts in room["polygons"]:
+            poly = np.array([[x * sx, y * sy] for x, y in pts], dtype=np.float32)
+            polygons.append(poly)
+            x0, y0 = np.floor(poly.min(axis=0)).astype(int)
+            x1, y1 = np.ceil(poly.max(axis=0)).astype(int)
+            x0, y0 = max(0, int(x0) - pad), max(0, int(y0) - pad)
+            x1, y1 = min(width, int(x1) + pad), min(height, int(y1) + pad)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            tiles.extend(
+                (x0 + a, y0 + b, x0 + c, y0 + d)
+                for a, b, c, d in tile_grid(x1 - x0, y1 - y0, tile, overlap)
+            )
+        geo = RoomGeometry(tiles, polygons)
+        with self._lock:
+            # don't cache geometry of a room re-registered meanwhile
+            if self._rooms.get(room_id) is room:
+                self._geometry[key] = geo
+        return geo
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._rooms, f)
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self._file_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
@@ -1,20 +1,56 @@
 # app/services/supabase_service.py
 from supabase import create_client
 from typing import List, Dict, Optional, Any
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from app.utils.http_client import get_session, get_async_client
+import asyncio
+import threading
 import time
 
+# download methods, in the order they are tried for a bucket we know nothing about
+DOWNLOAD_STRATEGIES = ("public", "signed", "client")
+
 class SupabaseService:
-    def __init__(self, url: str, key: str, service_role_key: Optional[str] = None):
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        service_role_key: Optional[str] = None,
+        signed_url_ttl: int = 3600,
+        signed_url_margin: int = 60,
+    ):
         """
         key: typically anon/public key
         service_role_key: the secret service_role key (use server-side only) — recommended for signed URLs
+        signed_url_ttl: lifetime of signed URLs used for downloads; they are cached
+            and reused until signed_url_margin seconds before expiry
         """
         self.client = create_client(url, key)
         self.url = url
         self.key = key
         # fallback to anon key if service_role_key not provided
         self.service_role_key = service_role_key or key
+        self._service_client = None
+        self._service_client_lock = threading.Lock()
+        # bucket -> download method that worked last time
+        self._bucket_strategy: Dict[str, str] = {}
+        self.signed_url_ttl = signed_url_ttl
+        self.signed_url_margin = signed_url_margin
+        # (bucket, path) -> (signed url, expires_at)
+        self._signed_urls: Dict[tuple, tuple] = {}
+        self._signed_urls_lock = threading.Lock()
+
+    @property
+    def service_client(self):
+        """Long-lived client with the service role key (same as self.client if no separate key)."""
+        if self.service_role_key == self.key:
+            return self.client
+        if self._service_client is None:
+            with self._service_client_lock:
+                if self._service_client is None:
+                    self._service_client = create_client(self.url, self.service_role_key)
+        return self._service_client
 
     def _extract_url_from_response(self, resp: Any, keys: List[str]):
         """
@@ -64,7 +100,13 @@ class SupabaseService:
 
         return None
 
-    def list_all_files_recursive(self, bucket: str, prefix: str = ""):
+    def list_all_objects_recursive(self, bucket: str, prefix: str = "") -> List[Dict[str, Any]]:
+        """
+        Walk a bucket (or a folder prefix) and return one dict per object:
+            {"path", "etag", "updated_at", "size"}
+        etag/updated_at come from the storage listing and are used as the
+        object's version when caching anything derived from it.
+        """
         results = []
         stack = [prefix]
 
@@ -91,23 +133,126 @@ class SupabaseService:
                 if item.get("metadata") is None:
                     stack.append(full_path)
                 else:
-                    results.append(full_path)
+                    results.append(self._object_from_item(full_path, item))
+
+        return results
+
+    @staticmethod
+    def _object_from_item(full_path: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        metadata = item.get("metadata") or {}
+        return {
+            "path": full_path,
+            "etag": (metadata.get("eTag") or "").strip('"'),
+            "updated_at": item.get("updated_at") or metadata.get("lastModified") or "",
+            "size": metadata.get("size") or metadata.get("contentLength") or 0,
+        }
+
+    def list_objects_updated_since(self, bucket: str, prefix: str, since: str = "", page_size: int = 100) -> List[Dict[str, Any]]:
+        """
+        Objects under prefix with updated_at > since, newest first.
+        Pages through the folder sorted by updated_at desc and stops at the
+        first page that reaches an object at or before the watermark.
+        Subfolders are walked in full. Deletions are not reported.
+        """
+        results = []
+        offset = 0
+        options = {"limit": page_size, "sortBy": {"column": "updated_at", "order": "desc"}}
+
+        while True:
+            try:
+                items = self.client.storage.from_(bucket).list(prefix, dict(options, offset=offset))
+            except Exception as e:
+                print("list error:", e)
+                break
+
+            if not items:
+                break
+
+            reached_watermark = False
+            for item in items:
+                name = item.get("name") or item.get("path") or ""
+                if not name:
+                    continue
+                full_path = f"{prefix}/{name}" if prefix else name
+
+                if item.get("metadata") is None:
+                    results.extend(
+                        o for o in self.list_all_objects_recursive(bucket, full_path)
+                        if not since or o["updated_at"] > since
+                    )
+                    continue
+
+                obj = self._object_from_item(full_path, item)
+                if since and obj["updated_at"] <= since:
+                    reached_watermark = True
+                    continue
+                results.append(obj)
+
+            if reached_watermark or len(items) < page_size:
+                break
+            offset += page_size
 
         return results
 
+    def list_all_files_recursive(self, bucket: str, prefix: str = ""):
+        return [obj["path"] for obj in self.list_all_objects_recursive(bucket, prefix)]
+
+    def find_folders(self, bucket: str, names: List[str], page_size: int = 1000) -> Dict[str, List[str]]:
+        """
+        Top-level folders matching names case-insensitively (after strip), as
+        {name: [actual folder names]}. Prefix listings are case-sensitive, so
+        this is how a "ABC123/" folder is found for roll ID "abc123".
+        One paged listing of the bucket root.
+        """
+        wanted = {n.lower().strip(): n for n in names}
+        found: Dict[str, List[str]] = {}
+        offset = 0
+        while True:
+            try:
+                items = self.client.storage.from_(bucket).list("", {"limit": page_size, "offset": offset})
+            except Exception as e:
+                print("list error:", e)
+                break
+            if not items:
+                break
+            for item in items:
+                name = item.get("name") or ""
+                # folders come back without metadata
+                if name and item.get("metadata") is None and name.lower().strip() in wanted:
+                    found.setdefault(wanted[name.lower().strip()], []).append(name)
+            if len(items) < page_size:
+                break
+            offset += page_size
+        return found
+
+    def list_objects_for_prefixes(self, bucket: str, prefixes: List[str], max_workers: int = 8,
+                                  executor: Optional[ThreadPoolExecutor] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        List several folder prefixes concurrently (bounded pool) instead of
+        walking the whole bucket. Returns {prefix: [object dicts]}.
+        Runs on `executor` if given (a long-lived shared pool), else on a
+        pool of max_workers threads created for this call.
+        """
+        prefixes = list(dict.fromkeys(p.strip("/") for p in prefixes if p))
+        if not prefixes:
+            return {}
+        if executor is not None:
+            listings = executor.map(lambda p: self.list_all_objects_recursive(bucket, p), prefixes)
+            return dict(zip(prefixes, listings))
+        workers = max(1, min(max_workers, len(prefixes)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="storage-list") as pool:
+            listings = pool.map(lambda p: self.list_all_objects_recursive(bucket, p), prefixes)
+            return dict(zip(prefixes, listings))
+
     def get_public_url(self, bucket: str, path: str) -> Optional[str]:
         """
-        Try to get the public URL for an object (works if object/bucket is public).
+        Public URL for an object (works if object/bucket is public).
+        Built locally from the project URL; no client call involved.
         """
-        try:
-            path = path.lstrip("/")
-            resp = self.client.storage.from_(bucket).get_public_url(path)
-            url = self._extract_url_from_response(resp, ["publicURL", "publicUrl", "public_url", "url"])
-            return url
-        except Exception as e:
-            # debug print to help during dev — remove if noisy
-            print("get_public_url error:", e)
+        path = path.lstrip("/")
+        if not self.url:
             return None
+        return f"{self.url.rstrip('/')}/storage/v1/object/public/{quote(bucket)}/{quote(path)}"
 
     def create_signed_url(self, bucket: str, path: str, expires_in: int = 3600) -> Optional[str]:
         """
@@ -115,50 +260,103 @@ class SupabaseService:
         """
         try:
             path = path.lstrip("/")
-
-            # If service_role_key differs from initial key, use a temporary client with service role key
-            if self.service_role_key and self.service_role_key != self.key:
-                temp_client = create_client(self.url, self.service_role_key)
-                resp = temp_client.storage.from_(bucket).create_signed_url(path, expires_in)
-            else:
-                resp = self.client.storage.from_(bucket).create_signed_url(path, expires_in)
-
+            resp = self.service_client.storage.from_(bucket).create_signed_url(path, expires_in)
             url = self._extract_url_from_response(resp, ["signedURL", "signedUrl", "signed_url", "signedurl"])
             return url
         except Exception as e:
             print("create_signed_url error:", e)
             return None
 
-    def download_bytes(self, bucket: str, path: str) -> Optional[bytes]:
+    def _cached_signed_url(self, bucket: str, path: str) -> Optional[str]:
+        with self._signed_urls_lock:
+            entry = self._signed_urls.get((bucket, path))
+            if entry is None:
+                return None
+            url, expires_at = entry
+            if time.time() >= expires_at - self.signed_url_margin:
+                del self._signed_urls[(bucket, path)]
+                return None
+            return url
+
+    def _remember_signed_url(self, bucket: str, path: str, url: str, expires_at: float):
+        with self._signed_urls_lock:
+            self._signed_urls[(bucket, path)] = (url, expires_at)
+
+    def create_signed_urls(self, bucket: str, paths: List[str], expires_in: Optional[int] = None, chunk_size: int = 500) -> Dict[str, str]:
         """
-        Robust download:
-         1) Try public URL
-         2) Try signed URL (service role)
-         3) Try direct client.download fallback
+        Signed URLs for many objects: cached ones are reused, the rest are
+        signed with one storage API call per chunk. Returns {path: url} for
+        every path that could be signed.
         """
-        path = path.lstrip("/")
+        expires_in = expires_in or self.signed_url_ttl
+        out = {}
+        todo = []
+        for path in dict.fromkeys(p.lstrip("/") for p in paths):
+            url = self._cached_signed_url(bucket, path)
+            if url:
+                out[path] = url
+            else:
+                todo.append(path)
 
-        # 1) public
-        url = self.get_public_url(bucket, path)
-        if url:
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            expires_at = time.time() + expires_in
             try:
-                r = requests.get(url, timeout=30)
-                r.raise_for_status()
-                return r.content
+                resp = self.service_client.storage.from_(bucket).create_signed_urls(chunk, expires_in)
             except Exception as e:
-                print("public URL fetch failed:", e)
+                print("create_signed_urls error:", e)
+                continue
+
+            items = resp.get("data", resp) if isinstance(resp, dict) else resp
+            for item in items or []:
+                if not isinstance(item, dict) or item.get("error"):
+                    continue
+                url = self._extract_url_from_response(item, ["signedURL", "signedUrl", "signed_url", "signedurl"])
+                path = item.get("path")
+                if url and path:
+                    out[path] = url
+                    self._remember_signed_url(bucket, path, url, expires_at)
+
+        return out
 
-        # 2) signed
-        url = self.create_signed_url(bucket, path, expires_in=120)
+    def presign(self, bucket: str, paths: List[str]):
+        """Warm the signed-URL cache for upcoming downloads, unless the bucket doesn't use signed URLs."""
+        if self._bucket_strategy.get(bucket, "signed") == "signed" and paths:
+            self.create_signed_urls(bucket, paths)
+
+    def _signed_url_for_download(self, bucket: str, path: str) -> Optional[str]:
+        url = self._cached_signed_url(bucket, path)
         if url:
-            try:
-                r = requests.get(url, timeout=30)
-                r.raise_for_status()
-                return r.content
-            except Exception as e:
-                print("signed URL fetch failed:", e)
+            return url
+        expires_at = time.time() + self.signed_url_ttl
+        url = self.create_signed_url(bucket, path, expires_in=self.signed_url_ttl)
+        if url:
+            self._remember_signed_url(bucket, path, url, expires_at)
+        return url
 
-        # 3) client.download fallback
+    def _fetch_url(self, url: Optional[str], label: str) -> Optional[bytes]:
+        if not url:
+            return None
+        try:
+            r = get_session().get(url, timeout=30)
+            r.raise_for_status()
+            return r.content
+        except Exception as e:
+            print(f"{label} URL fetch failed:", e)
+            return None
+
+    def _download_public(self, bucket: str, path: str) -> Optional[bytes]:
+        return self._fetch_url(self.get_public_url(bucket, path), "public")
+
+    def _download_signed(self, bucket: str, path: str) -> Optional[bytes]:
+        data = self._fetch_url(self._signed_url_for_download(bucket, path), "signed")
+        if data is None:
+            # don't keep reusing a URL that stopped working
+            with self._signed_urls_lock:
+                self._signed_urls.pop((bucket, path), None)
+        return data
+
+    def _download_client(self, bucket: str, path: str) -> Optional[bytes]:
         try:
             resp = self.client.storage.from_(bucket).download(path)
             if isinstance(resp, (bytes, bytearray)):
@@ -169,5 +367,76 @@ class SupabaseService:
                 return resp.content
         except Exception as e:
             print("client.download failed:", e)
+        return None
+
+    def download_bytes(self, bucket: str, path: str) -> Optional[bytes]:
+        """
+        Robust download:
+         1) Try public URL
+         2) Try signed URL (service role)
+         3) Try direct client.download fallback
+        The method that worked is remembered per bucket and tried first next
+        time, so e.g. a private bucket stops paying for a failed public fetch.
+        """
+        path = path.lstrip("/")
+
+        preferred = self._bucket_strategy.get(bucket)
+        order = DOWNLOAD_STRATEGIES
+        if preferred:
+            order = (preferred,) + tuple(m for m in DOWNLOAD_STRATEGIES if m != preferred)
+
+        for method in order:
+            data = getattr(self, f"_download_{method}")(bucket, path)
+            if data is not None:
+                if preferred != method:
+                    print(f"[SupabaseService] Using {method} downloads for bucket {bucket}")
+                    self._bucket_strategy[bucket] = method
+                return data
+
+        return None
+
+    async def _fetch_url_async(self, url: Optional[str], label: str) -> Optional[bytes]:
+        if not url:
+            return None
+        try:
+            r = await get_async_client().get(url, timeout=30)
+            r.raise_for_status()
+            return r.content
+        except Exception as e:
+            print(f"{label} URL fetch failed:", e)
+            return None
+
+    async def download_bytes_async(self, bucket: str, path: str) -> Optional[bytes]:
+        """
+        Same strategy as download_bytes, but URL fetches go through the async
+        HTTP client. Signing (cache misses only) and the client.download
+        fallback are blocking SDK calls and run in a worker thread.
+        """
+        path = path.lstrip("/")
+
+        preferred = self._bucket_strategy.get(bucket)
+        order = DOWNLOAD_STRATEGIES
+        if preferred:
+            order = (preferred,) + tuple(m for m in DOWNLOAD_STRATEGIES if m != preferred)
+
+        for method in order:
+            if method == "public":
+                data = await self._fetch_url_async(self.get_public_url(bucket, path), "public")
+            elif method == "signed":
+                url = self._cached_signed_url(bucket, path)
+                if url is None:
+                    url = await asyncio.to_thread(self._signed_url_for_download, bucket, path)
+                data = await self._fetch_url_async(url, "signed")
+                if data is None:
+                    with self._signed_urls_lock:
+                        self._signed_urls.pop((bucket, path), None)
+            else:
+                data = await asyncio.to_thread(self._download_client, bucket, path)
+
+            if data is not None:
+                if preferred != method:
+                    print(f"[SupabaseService] Using {method} downloads for bucket {bucket}")
+                    self._bucket_strategy[bucket] = method
+                return data
 
         return None
@@ -0,0 +1,56 @@
+# app/utils/detection_utils.py
+import math
+import numpy as np
+from typing import List, Optional, Tuple
+
+def tile_grid(width: int, height: int, tile: int, overlap: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Overlapping (x0, y0, x1, y1) tiles of at most tile x tile covering the image.
+    Tiles are spread evenly, so neighbours overlap by at least `overlap` pixels.
+    """
+    def starts(length):
+        if length <= tile:
+            return [0]
+        n = math.ceil((length - overlap) / (tile - overlap))
+        step = (length - tile) / (n - 1)
+        return [int(round(i * step)) for i in range(n)]
+
+    return [
+        (x, y, min(x + tile, width), min(y + tile, height))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+def merge_detections(
+    dets: np.ndarray,
+    kpss: Optional[np.ndarray],
+    iou_thresh: float = 0.4,
+    containment_thresh: float = 0.6,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Greedy NMS over detections gathered from several crops (dets: N x 5, x1 y1 x2 y2 score).
+    Besides the usual IoU test, a box mostly contained in a higher-scoring one
+    (intersection / smaller area >= containment_thresh) is dropped: a face cut
+    by a tile edge shows up as a partial box inside the full one.
+    """
+    if dets.shape[0] == 0:
+        return dets, kpss
+
+    x1, y1, x2, y2, scores = dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3], dets[:, 4]
+    areas = np.maximum(0.0, x2 - x1) * np.maximum(0.0, y2 - y1)
+    order = np.argsort(-scores, kind="stable")
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = w * h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        contained = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-6)
+        order = rest[(iou <= iou_thresh) & (contained < containment_thresh)]
+
+    keep = np.asarray(keep, dtype=np.int64)
+    return dets[keep], (kpss[keep] if kpss is not None else None)
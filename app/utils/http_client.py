@@ -0,0 +1,89 @@
+# app/utils/http_client.py
+import threading
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_session: Optional[requests.Session] = None
+_async_client: Optional[httpx.AsyncClient] = None
+_lock = threading.Lock()
+
+# defaults, overridden once at startup via configure()
+_settings = {
+    "pool_size": 32,
+    "max_retries": 2,
+    "backoff_factor": 0.3,
+}
+
+
+def configure(pool_size: int = 32, max_retries: int = 2, backoff_factor: float = 0.3):
+    """Set pool/retry settings. Must be called before the first get_session()."""
+    global _session
+    with _lock:
+        _settings.update(pool_size=pool_size, max_retries=max_retries, backoff_factor=backoff_factor)
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=_settings["max_retries"],
+        connect=_settings["max_retries"],
+        read=_settings["max_retries"],
+        status=_settings["max_retries"],
+        backoff_factor=_settings["backoff_factor"],
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=_settings["pool_size"],
+        pool_maxsize=_settings["pool_size"],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Process-wide pooled session (keep-alive + retries).
+    The underlying urllib3 connection pools are thread-safe; callers only use
+    plain GETs and must not mutate session state (headers, cookies, auth).
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Shared async client for the async request path (same pool size and
+    retry count as the sync session; connect errors are retried).
+    Must be used from the app's event loop; closed by aclose_async_client().
+    """
+    global _async_client
+    if _async_client is None:
+        limits = httpx.Limits(
+            max_connections=_settings["pool_size"],
+            max_keepalive_connections=_settings["pool_size"],
+        )
+        transport = httpx.AsyncHTTPTransport(limits=limits, retries=_settings["max_retries"])
+        _async_client = httpx.AsyncClient(transport=transport, follow_redirects=True)
+    return _async_client
+
+
+async def aclose_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
@@ -1,7 +1,7 @@
 # app/utils/image_utils.py
 import numpy as np
 import cv2
-from typing import Optional
+from typing import Optional, Tuple
 
 def bytes_to_bgr_image(data: bytes) -> Optional[np.ndarray]:
     """
@@ -11,3 +11,87 @@ def bytes_to_bgr_image(data: bytes) -> Optional[np.ndarray]:
     arr = np.frombuffer(data, dtype=np.uint8)
     img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
     return img  # BGR (cv2 uses BGR)
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...); C4/C8/CC are not SOF
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# recognition crops are 112x112; a face should keep at least this many pixels
+REC_FACE_PX = 112
+
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def read_image_size(data) -> Optional[Tuple[str, int, int]]:
+    """
+    (format, width, height) from the JPEG SOF segment or PNG IHDR chunk,
+    without decoding pixels. None for other/unknown formats.
+    """
+    if len(data) >= 24 and bytes(data[:8]) == b"\x89PNG\r\n\x1a\n" and bytes(data[12:16]) == b"IHDR":
+        return "png", int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+
+    i = 2
+    n = len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # markers without a length
+            i += 2
+            continue
+        seg_len = int.from_bytes(data[i + 2:i + 4], "big")
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            h = int.from_bytes(data[i + 5:i + 7], "big")
+            w = int.from_bytes(data[i + 7:i + 9], "big")
+            return "jpeg", w, h
+        i += 2 + seg_len
+    return None
+
+def pick_reduction(width: int, height: int, det_size: Tuple[int, int], min_face_px: int = REC_FACE_PX) -> int:
+    """
+    Largest JPEG DCT downscale factor (1, 2, 4 or 8) that loses nothing we use:
+      - the reduced image is still at least as large as what the detector
+        resizes it to (det_size, aspect ratio kept)
+      - a face of min_face_px (original pixels) still has >= REC_FACE_PX
+        pixels for recognition; min_face_px <= 0 skips this check
+    """
+    det_scale = min(det_size[0] / width, det_size[1] / height)
+    if det_scale >= 1.0:
+        return 1
+    for factor in (8, 4, 2):
+        if factor * det_scale > 1.0:
+            continue
+        if min_face_px > 0 and min_face_px / factor < REC_FACE_PX:
+            continue
+        return factor
+    return 1
+
+def decode_image_for_detection(data, det_size: Tuple[int, int], min_face_px: int = REC_FACE_PX) -> Tuple[Optional[np.ndarray], int]:
+    """
+    Decode image bytes to BGR, using IMREAD_REDUCED_COLOR_2/4/8 for JPEGs far
+    larger than the detector input (the downscale happens in the DCT domain,
+    so it is much faster and uses a fraction of the memory of a full decode).
+    Returns (img_or_None, reduction_factor).
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    factor = 1
+    info = read_image_size(data)
+    if info is not None and info[0] == "jpeg":
+        factor = pick_reduction(info[1], info[2], det_size, min_face_px)
+    img = cv2.imdecode(arr, _REDUCED_FLAGS[factor])
+    if img is None and factor != 1:
+        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+        factor = 1
+    return img, factor
@@ -0,0 +1,81 @@
+# app/utils/ort_options.py
+from typing import Dict, List, Union
+
+import onnxruntime
+
+_EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+_OPT_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# providers that take the arena settings as provider options
+_ARENA_PROVIDERS = ("CUDAExecutionProvider", "ROCMExecutionProvider")
+
+
+def make_session_options(opts: Dict) -> onnxruntime.SessionOptions:
+    """
+    SessionOptions from a config dict (see ORT_DET_OPTIONS / ORT_REC_OPTIONS in
+    app/config.py). Thread counts of 0 keep ONNX Runtime's default.
+    """
+    so = onnxruntime.SessionOptions()
+    if opts.get("intra_op_threads", 0) > 0:
+        so.intra_op_num_threads = opts["intra_op_threads"]
+    if opts.get("inter_op_threads", 0) > 0:
+        so.inter_op_num_threads = opts["inter_op_threads"]
+    mode = opts.get("execution_mode", "sequential")
+    if mode not in _EXECUTION_MODES:
+        raise ValueError(f"Unknown ONNX Runtime execution mode {mode!r}, expected one of {list(_EXECUTION_MODES)}")
+    so.execution_mode = _EXECUTION_MODES[mode]
+    level = opts.get("graph_optimization", "all")
+    if level not in _OPT_LEVELS:
+        raise ValueError(f"Unknown graph optimization level {level!r}, expected one of {list(_OPT_LEVELS)}")
+    so.graph_optimization_level = _OPT_LEVELS[level]
+    so.enable_cpu_mem_arena = opts.get("cpu_mem_arena", True)
+    so.enable_mem_pattern = opts.get("mem_pattern", True)
+    return so
+
+
+def resolve_providers(opts: Dict, use_gpu: bool) -> List[Union[str, tuple]]:
+    """
+    Allowed providers in priority order, filtered to the ones this
+    onnxruntime build has. Defaults to CUDA + CPU with USE_GPU, else CPU only.
+    GPU providers get the arena settings as provider options.
+    """
+    requested = opts.get("providers") or (
+        ["CUDAExecutionProvider", "CPUExecutionProvider"] if use_gpu else ["CPUExecutionProvider"]
+    )
+    available = set(onnxruntime.get_available_providers())
+    providers = []
+    for name in requested:
+        if name not in available:
+            print(f"[WARN] ONNX Runtime provider {name} is not available, skipping")
+            continue
+        provider_opts = {}
+        if name in _ARENA_PROVIDERS:
+            if opts.get("arena_extend_strategy"):
+                provider_opts["arena_extend_strategy"] = opts["arena_extend_strategy"]
+            if opts.get("gpu_mem_limit_mb", 0) > 0:
+                provider_opts["gpu_mem_limit"] = str(opts["gpu_mem_limit_mb"] * 1024 * 1024)
+        providers.append((name, provider_opts) if provider_opts else name)
+    if not providers:
+        providers = ["CPUExecutionProvider"]
+    return providers
+
+
+def describe_session(session: onnxruntime.InferenceSession) -> str:
+    """One-line summary of the providers and options a session actually runs with."""
+    so = session.get_session_options()
+    mode = {v: k for k, v in _EXECUTION_MODES.items()}.get(so.execution_mode, so.execution_mode)
+    level = {v: k for k, v in _OPT_LEVELS.items()}.get(so.graph_optimization_level, so.graph_optimization_level)
+    return (f"providers={session.get_providers()}, "
+            f"intra_op_threads={so.intra_op_num_threads or 'default'}, "
+            f"inter_op_threads={so.inter_op_num_threads or 'default'}, "
+            f"execution_mode={mode}, graph_optimization={level}, "
+            f"cpu_mem_arena={so.enable_cpu_mem_arena}, mem_pattern={so.enable_mem_pattern}")
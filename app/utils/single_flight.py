@@ -0,0 +1,87 @@
+# app/utils/single_flight.py
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable, List, Tuple
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent builds of the same keys: the first caller for a key
+    builds it, later callers wait for that result instead of building again.
+    Works for threads and asyncio tasks alike (results travel through
+    concurrent.futures.Future). A failed build is raised in every waiter.
+
+    build functions take the list of keys to build and return {key: value};
+    keys they leave out resolve to None and are left out for waiters too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        self.builds = 0
+        self.coalesced_waits = 0
+
+    def _claim(self, keys: List[Hashable]) -> Tuple[Dict[Hashable, Future], Dict[Hashable, Future]]:
+        mine, waits = {}, {}
+        with self._lock:
+            for key in keys:
+                fut = self._inflight.get(key)
+                if fut is None:
+                    fut = mine[key] = self._inflight[key] = Future()
+                else:
+                    waits[key] = fut
+            self.coalesced_waits += len(waits)
+            if mine:
+                self.builds += 1
+        return mine, waits
+
+    def _settle(self, mine: Dict[Hashable, Future], results=None, error: BaseException = None):
+        with self._lock:
+            for key in mine:
+                self._inflight.pop(key, None)
+        for key, fut in mine.items():
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(results.get(key))
+
+    def run(self, keys: List[Hashable], build_fn: Callable[[List[Hashable]], Dict]) -> Dict:
+        mine, waits = self._claim(keys)
+        results = {}
+        if mine:
+            try:
+                results = dict(build_fn(list(mine)))
+            except BaseException as e:
+                self._settle(mine, error=e)
+                raise
+            self._settle(mine, results)
+        for key, fut in waits.items():
+            value = fut.result()
+            if value is not None:
+                results[key] = value
+        return results
+
+    async def run_async(self, keys: List[Hashable], build_fn: Callable[[List[Hashable]], Awaitable[Dict]]) -> Dict:
+        mine, waits = self._claim(keys)
+        results = {}
+        if mine:
+            try:
+                results = dict(await build_fn(list(mine)))
+            except BaseException as e:
+                self._settle(mine, error=e)
+                raise
+            self._settle(mine, results)
+        for key, fut in waits.items():
+            value = await asyncio.wrap_future(fut)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "builds": self.builds,
+                "coalesced_waits": self.coalesced_waits,
+                "in_flight": len(self._inflight),
+            }
@@ -0,0 +1,81 @@
+# benchmarks/bench_coarse_to_fine.py
+"""
+Detection latency and face counts: fixed 1024 and 1600 detector input vs
+coarse-to-fine (coarse pass + tiles around small faces at the resolution
+that brings them to --refine-face-px).
+
+    python benchmarks/bench_coarse_to_fine.py path/to/hall1.jpg [path/to/hall2.jpg ...] [--repeat 5]
+
+Only detection is timed (no recognition). "match@1600" counts faces that
+overlap (IoU >= 0.5) a face found by the fixed 1600 pass.
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from app.services.face_service import FaceService
+
+
+def iou_matches(a: np.ndarray, b: np.ndarray, thresh: float = 0.5) -> int:
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    iou = inter / (area_a[:, None] + area_b[None, :] - inter)
+    return int((iou.max(axis=1) >= thresh).sum())
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("images", nargs="+")
+    ap.add_argument("--model", default="buffalo_l")
+    ap.add_argument("--coarse-size", type=int, default=640)
+    ap.add_argument("--tile-size", type=int, default=640)
+    ap.add_argument("--refine-face-px", type=int, default=48)
+    ap.add_argument("--refine-max-tiles", type=int, default=8)
+    ap.add_argument("--det-thresh", type=float, default=0.5)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    svc = FaceService(None, "", use_gpu=False, det_size=(1024, 1024), det_conf_threshold=args.det_thresh,
+                      model_name=args.model, det_mode="coarse_to_fine", coarse_det_size=args.coarse_size,
+                      tile_size=args.tile_size, refine_face_px=args.refine_face_px,
+                      refine_max_tiles=args.refine_max_tiles)
+    svc.init_face_app()
+
+    modes = {
+        "fixed-1024": lambda img: svc._detect_faces(img, input_size=(1024, 1024)),
+        "fixed-1600": lambda img: svc._detect_faces(img, input_size=(1600, 1600)),
+        "coarse-to-fine": lambda img: svc._detect_coarse_to_fine(img)[0],
+    }
+
+    for path in args.images:
+        img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+        print(f"\n{path}  {img.shape[1]}x{img.shape[0]}")
+        results = {}
+        for name, fn in modes.items():
+            fn(img)  # warm-up (session shapes, anchor caches)
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                faces = fn(img)
+                times.append(time.perf_counter() - t0)
+            boxes = np.array([f.bbox for f in faces], dtype=np.float32).reshape(-1, 4)
+            results[name] = (1000 * float(np.median(times)), boxes)
+
+        refined = svc._detect_coarse_to_fine(img)[1]
+        reference = results["fixed-1600"][1]
+        for name, (ms, boxes) in results.items():
+            print(f"  {name:15s} {ms:8.1f} ms  faces={len(boxes):4d}  match@1600={iou_matches(boxes, reference):4d}")
+        print(f"  coarse-to-fine refined {refined} tile(s) of {args.tile_size}px")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# benchmarks/bench_enrollment_downloads.py
+"""
+Reference-photo download time: a fresh connection per photo (module-level
+requests.get) vs the shared keep-alive pool in app.utils.http_client.
+
+    python benchmarks/bench_enrollment_downloads.py [--count 300] [--rounds 5]
+
+Uses the .env settings of the API. URLs are resolved up front so only the
+HTTP fetches are timed. One untimed pass warms the CDN / storage cache first;
+then each round runs both variants, alternating which goes first, and the
+medians over all rounds are reported.
+"""
+import argparse
+import statistics
+import time
+
+import requests
+
+from app.config import SUPABASE_URL, SUPABASE_KEY, SUPABASE_SERVICE_ROLE_KEY, STUDENT_BUCKET
+from app.services.supabase_service import SupabaseService
+from app.utils.http_client import get_session
+
+
+def fetch_all(get, urls):
+    t0 = time.perf_counter()
+    total = 0
+    for url in urls:
+        r = get(url, timeout=30)
+        r.raise_for_status()
+        total += len(r.content)
+    return time.perf_counter() - t0, total
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--count", type=int, default=300)
+    ap.add_argument("--bucket", default=STUDENT_BUCKET)
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+
+    supa = SupabaseService(SUPABASE_URL, SUPABASE_KEY, service_role_key=SUPABASE_SERVICE_ROLE_KEY)
+    paths = supa.list_all_files_recursive(args.bucket)[:args.count]
+    urls = [supa.create_signed_url(args.bucket, p, expires_in=3600) for p in paths]
+    urls = [u for u in urls if u]
+    print(f"photos: {len(urls)}")
+
+    # untimed pass, so neither variant pays for cold CDN / storage caches
+    _, size = fetch_all(get_session().get, urls)
+
+    variants = {"requests.get per photo": requests.get, "pooled session": get_session().get}
+    times = {name: [] for name in variants}
+    for i in range(max(1, args.rounds)):
+        order = list(variants) if i % 2 == 0 else list(reversed(variants))
+        for name in order:
+            times[name].append(fetch_all(variants[name], urls)[0])
+
+    for name, ts in times.items():
+        med = statistics.median(ts)
+        print(f"{name:23s}: {med:7.2f} s median  ({1000 * med / len(urls):.1f} ms/photo, "
+              f"min {min(ts):.2f} s, max {max(ts):.2f} s, {len(ts)} rounds)")
+    print(f"downloaded {size / 1e6:.1f} MB per pass")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from app.services.bucket_index import BucketIndex
+
+
+class FakeStorage:
+    """In-memory bucket with the listing calls BucketIndex uses."""
+
+    def __init__(self, objects=None):
+        # path -> (etag, updated_at)
+        self.objects = dict(objects or {})
+        self.walks = 0
+        self.since_calls = []
+        self.on_walk = None
+
+    def _obj(self, path):
+        etag, updated_at = self.objects[path]
+        return {"path": path, "etag": etag, "updated_at": updated_at, "size": 1}
+
+    def list_all_objects_recursive(self, bucket, prefix=""):
+        self.walks += 1
+        listing = [self._obj(p) for p in sorted(self.objects) if p.startswith(prefix)]
+        if self.on_walk is not None:
+            self.on_walk()
+        return listing
+
+    def list_objects_updated_since(self, bucket, prefix, since="", page_size=100):
+        self.since_calls.append((prefix, since))
+        return [self._obj(p) for p in sorted(self.objects)
+                if p.startswith(prefix + "/") and (not since or self.objects[p][1] > since)]
+
+    def find_folders(self, bucket, names):
+        found = {}
+        for folder in sorted({p.split("/")[0] for p in self.objects}):
+            if folder.lower().strip() in names:
+                found.setdefault(folder.lower().strip(), []).append(folder)
+        return found
+
+
+def _paths(index, roll_ids):
+    return {rid: [o["path"] for o in objs] for rid, objs in index.objects_for_rolls("b", roll_ids).items()}
+
+
+def test_full_sync_indexes_and_removes_deleted_objects(tmp_path):
+    storage = FakeStorage({"a/1.jpg": ("e1", "2024-01-01"), "b/1.jpg": ("e2", "2024-01-01")})
+    index = BucketIndex(str(tmp_path / "index.db"))
+    assert index.full_sync(storage, "b") == {"a", "b"}
+    assert _paths(index, ["a", "b"]) == {"a": ["a/1.jpg"], "b": ["b/1.jpg"]}
+    assert index.generations("b", ["a", "b", "c"]) == {"a": 1, "b": 1, "c": 0}
+
+    del storage.objects["b/1.jpg"]
+    assert index.full_sync(storage, "b") == {"b"}
+    assert _paths(index, ["a", "b"]) == {"a": ["a/1.jpg"]}
+    # the emptied roll keeps counting up, so older blocks never match again
+    assert index.generations("b", ["a", "b"]) == {"a": 1, "b": 2}
+
+
+def test_refresh_lists_from_the_watermark(tmp_path):
+    storage = FakeStorage({"a/1.jpg": ("e1", "2024-01-01")})
+    index = BucketIndex(str(tmp_path / "index.db"))
+    assert index.refresh_rolls(storage, "b", ["a"]) == {"a"}
+    assert storage.since_calls == [("a", "")]
+
+    storage.objects["a/2.jpg"] = ("e2", "2024-02-01")
+    assert index.refresh_rolls(storage, "b", ["a"]) == {"a"}
+    assert storage.since_calls[-1] == ("a", "2024-01-01")
+    assert _paths(index, ["a"]) == {"a": ["a/1.jpg", "a/2.jpg"]}
+
+    assert index.refresh_rolls(storage, "b", ["a"]) == set()
+    assert storage.since_calls[-1] == ("a", "2024-02-01")
+    assert index.generations("b", ["a"]) == {"a": 2}
+
+
+def test_refresh_finds_mixed_case_folders(tmp_path):
+    storage = FakeStorage({"ABC/1.jpg": ("e1", "2024-01-01")})
+    index = BucketIndex(str(tmp_path / "index.db"))
+    assert index.refresh_rolls(storage, "b", ["abc"]) == {"abc"}
+    assert _paths(index, ["abc"]) == {"abc": ["ABC/1.jpg"]}
+
+    storage.objects["ABC/2.jpg"] = ("e2", "2024-02-01")
+    assert index.refresh_rolls(storage, "b", ["abc"]) == {"abc"}
+    assert len(_paths(index, ["abc"])["abc"]) == 2
+
+
+def test_full_sync_leaves_rolls_refreshed_during_the_walk_alone(tmp_path):
+    storage = FakeStorage({"a/1.jpg": ("e1", "2024-01-01")})
+    index = BucketIndex(str(tmp_path / "index.db"))
+    index.full_sync(storage, "b")
+
+    def upload_and_refresh():
+        # after the walk listed a/1.jpg at e1: a newer version is uploaded and refreshed
+        storage.objects["a/1.jpg"] = ("e9", "2024-03-01")
+        index.refresh_rolls(storage, "b", ["a"])
+
+    storage.on_walk = upload_and_refresh
+    index.full_sync(storage, "b")
+    assert index.objects_for_rolls("b", ["a"])["a"][0]["etag"] == "e9"
+
+
+def test_two_instances_share_generations_and_one_full_walk(tmp_path):
+    storage = FakeStorage({"a/1.jpg": ("e1", "2024-01-01")})
+    db = str(tmp_path / "index.db")
+    first, second = BucketIndex(db, refresh_seconds=0), BucketIndex(db, refresh_seconds=0)
+
+    first.start_full_sync(storage, "b")
+    first._full_sync_thread.join(5)
+    second.start_full_sync(storage, "b")
+    second._full_sync_thread.join(5)
+    assert storage.walks == 1
+
+    before = second.generations("b", ["a"])["a"]
+    storage.objects["a/1.jpg"] = ("e2", "2024-02-01")
+    assert first.sync(storage, "b", ["a"]) == {"a"}
+    assert second.generations("b", ["a"])["a"] == before + 1
+    assert second.objects_for_rolls("b", ["a"])["a"][0]["etag"] == "e2"
@@ -0,0 +1,59 @@
+import numpy as np
+
+from app.utils.detection_utils import merge_detections, tile_grid
+
+
+def _covered(tiles, width, height):
+    mask = np.zeros((height, width), dtype=bool)
+    for x0, y0, x1, y1 in tiles:
+        mask[y0:y1, x0:x1] = True
+    return mask.all()
+
+
+def test_tile_grid_small_image_is_one_tile():
+    assert tile_grid(300, 200, 640, 128) == [(0, 0, 300, 200)]
+
+
+def test_tile_grid_covers_frame_with_overlap():
+    tiles = tile_grid(1920, 1080, 640, 128)
+    assert _covered(tiles, 1920, 1080)
+    for x0, y0, x1, y1 in tiles:
+        assert 0 <= x0 < x1 <= 1920 and 0 <= y0 < y1 <= 1080
+        assert x1 - x0 <= 640 and y1 - y0 <= 640
+    xs = sorted({t[0] for t in tiles})
+    ends = sorted({t[2] for t in tiles})
+    # neighbouring columns overlap by at least the requested amount
+    assert all(end - start >= 128 for start, end in zip(xs[1:], ends[:-1]))
+
+
+def test_tile_grid_exact_fit():
+    tiles = tile_grid(1280, 640, 640, 0)
+    assert sorted(tiles) == [(0, 0, 640, 640), (640, 0, 1280, 640)]
+
+
+def _det(x0, y0, x1, y1, score):
+    return [x0, y0, x1, y1, score]
+
+
+def test_merge_detections_suppresses_duplicates_across_tiles():
+    dets = np.array([_det(100, 100, 150, 150, 0.9), _det(102, 101, 151, 152, 0.8),
+                     _det(400, 400, 450, 450, 0.7)], dtype=np.float32)
+    kpss = np.arange(3 * 5 * 2, dtype=np.float32).reshape(3, 5, 2)
+    out, out_kps = merge_detections(dets, kpss)
+    assert out.shape == (2, 5)
+    assert np.allclose(out[:, 4], [0.9, 0.7])
+    assert np.array_equal(out_kps[0], kpss[0]) and np.array_equal(out_kps[1], kpss[2])
+
+
+def test_merge_detections_drops_face_cut_by_tile_border():
+    # a partial face at a tile edge lies mostly inside the full detection from the neighbouring tile
+    full = _det(100, 100, 160, 160, 0.9)
+    cut = _det(100, 100, 130, 160, 0.6)
+    out, out_kps = merge_detections(np.array([cut, full], dtype=np.float32), None)
+    assert out_kps is None
+    assert out.shape[0] == 1 and np.allclose(out[0, :4], full[:4])
+
+
+def test_merge_detections_empty():
+    out, out_kps = merge_detections(np.empty((0, 5), dtype=np.float32), None)
+    assert out.shape == (0, 5) and out_kps is None
@@ -0,0 +1,116 @@
+import json
+
+import numpy as np
+
+from app.services.embedding_store import EmbeddingStore, settings_fingerprint
+
+
+def _emb(seed, dim=8):
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def test_put_is_visible_before_and_after_flush(tmp_path):
+    store = EmbeddingStore(str(tmp_path), "m", initial_capacity=4)
+    a = _emb(1)
+    store.put("r1", "r1/a.jpg", "v1", a)
+    hit, got = store.lookup("r1", "r1/a.jpg", "v1")
+    assert hit and np.allclose(got, a)
+    store.flush()
+
+    reopened = EmbeddingStore(str(tmp_path), "m")
+    hit, got = reopened.lookup("r1", "r1/a.jpg", "v1")
+    assert hit and np.allclose(got, a)
+    assert reopened.lookup("r1", "r1/a.jpg", "v2") == (False, None)
+    assert len(reopened) == 1
+
+
+def test_no_face_entry(tmp_path):
+    store = EmbeddingStore(str(tmp_path), "m")
+    store.put("r1", "r1/blurry.jpg", "v1", None)
+    store.flush()
+    assert EmbeddingStore(str(tmp_path), "m").lookup("r1", "r1/blurry.jpg", "v1") == (True, None)
+
+
+def test_two_processes_do_not_share_rows(tmp_path):
+    # two workers opened the store before either wrote anything
+    a = EmbeddingStore(str(tmp_path), "m", initial_capacity=4)
+    b = EmbeddingStore(str(tmp_path), "m", initial_capacity=4)
+    alice, bob = _emb(1), _emb(2)
+    a.put("alice", "alice/1.jpg", "v1", alice)
+    a.flush()
+    b.put("bob", "bob/1.jpg", "v1", bob)
+    b.flush()
+
+    for store in (a, b, EmbeddingStore(str(tmp_path), "m")):
+        assert np.allclose(store.lookup("alice", "alice/1.jpg", "v1")[1], alice)
+        assert np.allclose(store.lookup("bob", "bob/1.jpg", "v1")[1], bob)
+    with open(tmp_path / "m" / EmbeddingStore.INDEX_FILE) as f:
+        index = json.load(f)
+    assert index["alice/1.jpg"]["row"] != index["bob/1.jpg"]["row"]
+
+
+def test_sees_other_process_resize(tmp_path):
+    a = EmbeddingStore(str(tmp_path), "m", initial_capacity=2)
+    b = EmbeddingStore(str(tmp_path), "m", initial_capacity=2)
+    a.put("x", "x/0.jpg", "v1", _emb(0))
+    a.flush()
+    assert b.lookup("x", "x/0.jpg", "v1")[0]  # b maps the 2-row matrix
+
+    embs = {f"x/{i}.jpg": _emb(i) for i in range(1, 6)}
+    for path, emb in embs.items():
+        a.put("x", path, "v1", emb)
+    a.flush()  # grows and replaces the matrix file
+
+    for path, emb in embs.items():
+        hit, got = b.lookup("x", path, "v1")
+        assert hit and np.allclose(got, emb)
+
+
+def test_superseded_row_is_reused_after_next_flush(tmp_path):
+    store = EmbeddingStore(str(tmp_path), "m", initial_capacity=2)
+    store.put("r", "r/a.jpg", "v1", _emb(1))
+    store.put("r", "r/b.jpg", "v1", _emb(2))
+    store.flush()
+    with open(tmp_path / "m" / EmbeddingStore.INDEX_FILE) as f:
+        old_row = json.load(f)["r/a.jpg"]["row"]
+
+    # the re-uploaded photo must not overwrite the row the on-disk index still points at
+    store.put("r", "r/a.jpg", "v2", _emb(3))
+    store.flush()
+    with open(tmp_path / "m" / EmbeddingStore.INDEX_FILE) as f:
+        index = json.load(f)
+    assert index["r/a.jpg"]["row"] not in (old_row, index["r/b.jpg"]["row"])
+
+    # once the index no longer references it, the old row is handed out again
+    store.put("r", "r/c.jpg", "v1", _emb(4))
+    store.flush()
+    with open(tmp_path / "m" / EmbeddingStore.INDEX_FILE) as f:
+        assert json.load(f)["r/c.jpg"]["row"] == old_row
+
+
+def test_rows_are_written_before_index(tmp_path, monkeypatch):
+    store = EmbeddingStore(str(tmp_path), "m")
+    store.put("r", "r/a.jpg", "v1", _emb(1))
+    store.flush()
+    events = []
+    real_replace = __import__("os").replace
+    matrix_flush = store._matrix.flush
+
+    monkeypatch.setattr(store._matrix, "flush", lambda: (events.append("matrix"), matrix_flush())[1])
+    monkeypatch.setattr("app.services.embedding_store.os.replace",
+                        lambda src, dst: (events.append(dst.rsplit("/", 1)[-1]), real_replace(src, dst))[1])
+    store.put("r", "r/b.jpg", "v1", _emb(2))
+    store.flush()
+    assert events == ["matrix", EmbeddingStore.INDEX_FILE]
+
+
+def test_no_face_entries_do_not_survive_settings_change(tmp_path):
+    old = settings_fingerprint(enroll_det_size=640, det_conf_threshold=0.25)
+    new = settings_fingerprint(enroll_det_size=640, det_conf_threshold=0.5)
+    assert old != new and old == settings_fingerprint(det_conf_threshold=0.25, enroll_det_size=640)
+
+    store = EmbeddingStore(str(tmp_path), "m", fingerprint=old)
+    store.put("r", "r/a.jpg", "v1", None)
+    store.flush()
+    assert EmbeddingStore(str(tmp_path), "m", fingerprint=old).lookup("r", "r/a.jpg", "v1") == (True, None)
+    assert EmbeddingStore(str(tmp_path), "m", fingerprint=new).lookup("r", "r/a.jpg", "v1") == (False, None)
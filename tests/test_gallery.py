@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from app.services.gallery import Gallery, GallerySnapshots, _grouped_max
+
+
+def _block(seed, k=2, dim=8):
+    return np.random.default_rng(seed).standard_normal((k, dim)).astype(np.float32)
+
+
+def _unit(block):
+    return block / np.linalg.norm(block, axis=1, keepdims=True)
+
+
+def test_grouped_max():
+    values = np.array([0.1, 0.9, 0.3, 0.5, 0.2], dtype=np.float32)
+    labels = np.array([2, 0, 2, 0, 1], dtype=np.int32)
+    assert np.allclose(_grouped_max(values, labels, 4), [0.9, 0.2, 0.3, -np.inf])
+
+
+def test_grouped_max_empty():
+    out = _grouped_max(np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int32), 3)
+    assert np.all(np.isneginf(out))
+
+
+def test_from_blocks_normalizes_and_labels():
+    a, b = _block(1, 2), _block(2, 3)
+    g = Gallery.from_blocks([("a", a), ("b", b)])
+    assert len(g) == 5 and g.students() == ["a", "b"]
+    assert np.allclose(np.linalg.norm(g.matrix, axis=1), 1.0)
+    assert list(g.labels) == [0, 0, 1, 1, 1]
+
+
+def test_remove_fills_holes_and_keeps_rows_with_their_labels():
+    blocks = {"a": _block(1, 2), "b": _block(2, 3), "c": _block(3, 1)}
+    g = Gallery.from_blocks(blocks.items())
+    assert g.remove("a")
+    assert not g.remove("a")
+    assert len(g) == 4 and "a" not in g
+    for name in ("b", "c"):
+        rows = g.matrix[g.labels == g.ids[name]]
+        expected = _unit(blocks[name])
+        assert rows.shape == expected.shape
+        assert {tuple(np.round(r, 5)) for r in rows} == {tuple(np.round(r, 5)) for r in expected}
+
+
+def test_freed_id_is_reused():
+    g = Gallery.from_blocks([("a", _block(1)), ("b", _block(2))])
+    sid = g.ids["a"]
+    g.remove("a")
+    assert g.names[sid] is None and g.num_ids == 2
+    assert g.add("c", _block(3)) == sid
+    assert g.num_ids == 2 and g.names[sid] == "c"
+
+
+def test_add_replaces_existing_student():
+    g = Gallery.from_blocks([("a", _block(1, 2)), ("b", _block(2, 2))])
+    g.add("a", _block(3, 1))
+    assert len(g) == 3 and sorted(g.students()) == ["a", "b"]
+    assert (g.labels == g.ids["a"]).sum() == 1
+
+
+def test_best_scores_per_student():
+    a, b = _block(1, 2), _block(2, 1)
+    g = Gallery.from_blocks([("a", a), ("b", b)])
+    scores = g.best_scores(a[1:2])
+    assert scores.shape == (2,)
+    assert scores[g.ids["a"]] == pytest.approx(1.0, abs=1e-5)
+    assert scores[g.ids["b"]] < scores[g.ids["a"]]
+
+
+def test_frozen_gallery_rejects_updates():
+    g = Gallery.from_blocks([("a", _block(1))]).freeze()
+    with pytest.raises(RuntimeError):
+        g.add("b", _block(2))
+    with pytest.raises(RuntimeError):
+        g.remove("a")
+    copy = g.copy()
+    copy.add("b", _block(2))
+    assert "b" in copy and "b" not in g
+
+
+def test_snapshots_publish_new_version_only_on_change():
+    snaps = GallerySnapshots()
+    blocks = {"a": _block(1), "b": _block(2)}
+    key = snaps.roster_key(blocks)
+    v1 = snaps.resolve(key, blocks)
+    assert snaps.resolve(key, dict(blocks)) is v1 and v1.frozen
+
+    snaps.update_students({"b": _block(3)})
+    v2 = snaps.current(key)
+    assert v2 is not v1 and v2.version == v1.version + 1
+    assert np.allclose(v1.matrix[v1.labels == v1.ids["b"]], _unit(blocks["b"]))
+
+
+def test_snapshots_drop_rosters_of_evicted_students():
+    snaps = GallerySnapshots()
+    ab = {"a": _block(1), "b": _block(2)}
+    c = {"c": _block(3)}
+    snaps.resolve(snaps.roster_key(ab), ab)
+    snaps.resolve(snaps.roster_key(c), c)
+
+    snaps.drop_students(["b"])
+    assert snaps.current(snaps.roster_key(ab)) is None
+    assert snaps.current(snaps.roster_key(c)) is not None
+    assert snaps.stats()["dropped"] == 1
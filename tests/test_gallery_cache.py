@@ -0,0 +1,98 @@
+import threading
+import time
+
+import numpy as np
+
+from app.services.gallery_cache import GalleryCache
+
+
+def _block(value, k=1, dim=4):
+    # k x dim float32: 16 * k bytes
+    return np.full((k, dim), value, dtype=np.float32)
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_lru_eviction_by_bytes():
+    evicted = []
+    cache = GalleryCache(max_bytes=3 * 16, ttl_seconds=60, on_evict=evicted.extend)
+    for key in "abc":
+        cache.put(key, _block(1))
+    cache.get("a")
+    cache.put("d", _block(1))
+
+    assert evicted == ["b"]
+    assert cache.get("b") == (None, False)
+    assert cache.get("a")[0] is not None
+    stats = cache.stats()
+    assert stats["entries"] == 3 and stats["bytes"] == 3 * 16 and stats["evictions"] == 1
+
+
+def test_blocks_are_read_only():
+    cache = GalleryCache(max_bytes=1024, ttl_seconds=60)
+    cache.put("a", _block(1))
+    block, _ = cache.get("a")
+    assert not block.flags.writeable
+
+
+def test_ttl_marks_entries_stale():
+    cache = GalleryCache(max_bytes=1024, ttl_seconds=0)
+    cache.put("a", _block(1))
+    time.sleep(0.01)
+    block, stale = cache.get("a")
+    assert block is not None and stale
+    assert cache.stats()["stale_hits"] == 1
+
+
+def test_tag_mismatch_is_a_miss():
+    evicted = []
+    cache = GalleryCache(max_bytes=1024, ttl_seconds=60, on_evict=evicted.extend)
+    cache.put("a", _block(1), tag=1)
+    assert cache.get("a", tag=1)[0] is not None
+    assert cache.get("a", tag=2) == (None, False)
+    assert evicted == ["a"] and cache.stats()["entries"] == 0
+
+
+def test_refresh_async_replaces_and_removes_blocks():
+    cache = GalleryCache(max_bytes=1024, ttl_seconds=0)
+    cache.put("a", _block(1))
+    cache.put("b", _block(1))
+    refreshed = []
+
+    cache.refresh_async(["a", "b"], lambda keys: {"a": (_block(2), 7), "b": (None, 7)},
+                        on_refreshed=refreshed.append)
+    _wait_for(lambda: cache.stats()["refreshes"] == 1)
+
+    assert cache.get("a", tag=7)[0][0, 0] == 2
+    assert cache.get("b") == (None, False)
+    assert list(refreshed[0]) == ["a"]
+
+
+def test_refresh_async_drops_results_for_changed_entries():
+    cache = GalleryCache(max_bytes=1024, ttl_seconds=60)
+    for key in "abc":
+        cache.put(key, _block(1))
+    started, release = threading.Event(), threading.Event()
+
+    def build(keys):
+        started.set()
+        release.wait(5)
+        return {key: (_block(2), None) for key in keys}
+
+    cache.refresh_async(["a", "b", "c"], build)
+    started.wait(5)
+    cache.invalidate("a")
+    cache.put("b", _block(3))
+    # already refreshing: not scheduled twice
+    cache.refresh_async(["c"], build)
+    release.set()
+    _wait_for(lambda: cache.stats()["refreshes"] == 1)
+
+    assert cache.get("a") == (None, False)
+    assert cache.get("b")[0][0, 0] == 3
+    assert cache.get("c")[0][0, 0] == 2
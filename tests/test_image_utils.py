@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+from app.utils.image_utils import REC_FACE_PX, decode_image_for_detection, pick_reduction, read_image_size
+
+
+def _encode(ext, width, height, params=()):
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    ok, buf = cv2.imencode(ext, img, list(params))
+    assert ok
+    return buf.tobytes()
+
+
+def test_read_image_size_jpeg():
+    assert read_image_size(_encode(".jpg", 640, 480)) == ("jpeg", 640, 480)
+
+
+def test_read_image_size_progressive_jpeg():
+    data = _encode(".jpg", 321, 123, (cv2.IMWRITE_JPEG_PROGRESSIVE, 1))
+    assert read_image_size(data) == ("jpeg", 321, 123)
+
+
+def test_read_image_size_skips_app_segments():
+    data = _encode(".jpg", 200, 100)
+    # insert an APP1 segment containing a fake SOF marker before the real header
+    payload = b"\xff\xc0\x00\x11\x08\x00\x01\x00\x01" + b"\x00" * 8
+    app1 = b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload
+    assert read_image_size(data[:2] + app1 + data[2:]) == ("jpeg", 200, 100)
+
+
+def test_read_image_size_png():
+    assert read_image_size(_encode(".png", 33, 17)) == ("png", 33, 17)
+
+
+def test_read_image_size_unknown_or_truncated():
+    assert read_image_size(b"") is None
+    assert read_image_size(b"GIF89a" + b"\x00" * 32) is None
+    assert read_image_size(_encode(".jpg", 64, 64)[:4]) is None
+
+
+def test_pick_reduction_respects_detector_size():
+    assert pick_reduction(1000, 800, (1024, 1024), 0) == 1
+    assert pick_reduction(4096, 3072, (1024, 1024), 0) == 4
+    assert pick_reduction(4000, 3000, (1024, 1024), 0) == 2  # 1/4 would be below 1024 wide
+
+
+def test_pick_reduction_keeps_face_detail():
+    # by default every face of REC_FACE_PX or more keeps full detail: no reduction
+    assert pick_reduction(8192, 6144, (1024, 1024)) == 1
+    assert pick_reduction(8192, 6144, (1024, 1024), 4 * REC_FACE_PX) == 4
+    assert pick_reduction(8192, 6144, (1024, 1024), 2 * REC_FACE_PX) == 2
+
+
+def test_pick_reduction_enrollment_portrait():
+    # 12 MP phone portrait, 640 enrollment detector input, 448 px minimum face
+    assert pick_reduction(4000, 3000, (640, 640), 4 * REC_FACE_PX) == 4
+
+
+def test_decode_image_for_detection_reduces():
+    data = _encode(".jpg", 2048, 1024)
+    img, factor = decode_image_for_detection(data, (512, 512), 0)
+    assert factor == 4 and img.shape[:2] == (256, 512)
+    img, factor = decode_image_for_detection(data, (512, 512))
+    assert factor == 1 and img.shape[:2] == (1024, 2048)
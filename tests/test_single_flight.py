@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+
+from app.utils.single_flight import SingleFlight
+
+
+def _wait_for_coalesced(sf, n, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while sf.stats()["coalesced_waits"] < n:
+        assert time.monotonic() < deadline, "second caller never joined the build"
+        time.sleep(0.001)
+
+
+def test_concurrent_callers_share_one_build():
+    sf = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def build(keys):
+        calls.append(list(keys))
+        started.set()
+        release.wait(5)
+        return {k: k.upper() for k in keys}
+
+    results = {}
+    first = threading.Thread(target=lambda: results.setdefault("first", sf.run(["a", "b"], build)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.setdefault("second", sf.run(["b", "c"], build)))
+    second.start()
+    _wait_for_coalesced(sf, 1)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert calls == [["a", "b"], ["c"]]
+    assert results["first"] == {"a": "A", "b": "B"}
+    assert results["second"] == {"b": "B", "c": "C"}
+    assert sf.stats() == {"builds": 2, "coalesced_waits": 1, "in_flight": 0}
+
+
+def test_missing_keys_are_left_out():
+    sf = SingleFlight()
+    assert sf.run(["a", "b"], lambda keys: {"a": 1}) == {"a": 1}
+
+
+def test_error_is_raised_in_builder_and_waiters():
+    sf = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def build(keys):
+        started.set()
+        release.wait(5)
+        raise ValueError("listing failed")
+
+    errors = []
+
+    def call():
+        try:
+            sf.run(["a"], build)
+        except ValueError as e:
+            errors.append(str(e))
+
+    builder = threading.Thread(target=call)
+    builder.start()
+    started.wait(5)
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    _wait_for_coalesced(sf, 1)
+    release.set()
+    builder.join(5)
+    waiter.join(5)
+
+    assert errors == ["listing failed", "listing failed"]
+    # the failed key is not stuck in flight: the next caller builds again
+    assert sf.stats()["in_flight"] == 0
+    assert sf.run(["a"], lambda keys: {"a": 1}) == {"a": 1}
+
+
+def test_run_async_coalesces_and_propagates_errors():
+    sf = SingleFlight()
+
+    async def main():
+        gate = asyncio.Event()
+        calls = []
+
+        async def build(keys):
+            calls.append(list(keys))
+            await gate.wait()
+            return {k: len(k) for k in keys}
+
+        first = asyncio.create_task(sf.run_async(["ab"], build))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(sf.run_async(["ab"], build))
+        await asyncio.sleep(0)
+        gate.set()
+        assert await first == {"ab": 2} and await second == {"ab": 2}
+        assert calls == [["ab"]]
+
+        async def failing(keys):
+            await asyncio.sleep(0)
+            raise KeyError("boom")
+
+        results = await asyncio.gather(sf.run_async(["x"], failing), sf.run_async(["x"], failing),
+                                       return_exceptions=True)
+        assert all(isinstance(r, KeyError) for r in results)
+
+    asyncio.run(main())